@@ -0,0 +1,75 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import metrics
+import tracing
+
+# Every query runs on this one thread so sqlite never blocks the event loop,
+# and the shared connection is never touched by two threads at once
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+
+def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def wrap(name):
+    # Looked up on call, db may still be partially imported at this point
+    # (db -> util -> adb -> db)
+    async def wrapper(*args, **kwargs):
+        with tracing.span(f"db.{name}"), metrics.DB_DURATION.time(query=name):
+            return await run(getattr(db, name), *args, **kwargs)
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+init = wrap("init")
+flush = wrap("flush")
+suspend_write_behind = wrap("suspend_write_behind")
+resume_write_behind = wrap("resume_write_behind")
+update_link_entry = wrap("update_link_entry")
+update_hsr_link_entry = wrap("update_hsr_link_entry")
+create_alt_entry = wrap("create_alt_entry")
+delete_alt_entry = wrap("delete_alt_entry")
+get_alt_data = wrap("get_alt_data")
+get_all_alts = wrap("get_all_alts")
+alt_uid_exists = wrap("alt_uid_exists")
+set_account_id = wrap("set_account_id")
+set_cookie_token = wrap("set_cookie_token")
+set_daily_reward = wrap("set_daily_reward")
+set_hsr_daily_reward = wrap("set_hsr_daily_reward")
+set_activity_tracking = wrap("set_activity_tracking")
+get_link_entry = wrap("get_link_entry")
+get_hsr_link_entry = wrap("get_hsr_link_entry")
+link_cache_stats = wrap("link_cache_stats")
+get_all_auto_checkin_users = wrap("get_all_auto_checkin_users")
+get_all_hsr_auto_checkin_users = wrap("get_all_hsr_auto_checkin_users")
+get_all_tracked_users = wrap("get_all_tracked_users")
+get_latest_activity = wrap("get_latest_activity")
+get_latest_tracked_activities = wrap("get_latest_tracked_activities")
+uid_exists = wrap("uid_exists")
+hsr_uid_exists = wrap("hsr_uid_exists")
+delete_entry_by_uid = wrap("delete_entry_by_uid")
+hsr_delete_entry_by_uid = wrap("hsr_delete_entry_by_uid")
+user_count = wrap("user_count")
+get_last_seen = wrap("get_last_seen")
+log_activity = wrap("log_activity")
+compact_activities = wrap("compact_activities")
+purge_activities = wrap("purge_activities")
+save_shard_report = wrap("save_shard_report")
+get_shard_reports = wrap("get_shard_reports")
+create_reward_run = wrap("create_reward_run")
+get_open_reward_runs = wrap("get_open_reward_runs")
+finish_reward_run = wrap("finish_reward_run")
+save_reward_checkpoint = wrap("save_reward_checkpoint")
+get_reward_checkpoints = wrap("get_reward_checkpoints")
+purge_reward_runs = wrap("purge_reward_runs")
+record_claim = wrap("record_claim")
+get_claim = wrap("get_claim")
+get_claimed_accounts = wrap("get_claimed_accounts")
+quarantine_account = wrap("quarantine_account")
+get_quarantined_accounts = wrap("get_quarantined_accounts")
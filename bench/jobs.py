@@ -0,0 +1,426 @@
+# Runs the real daily reward and activity feed jobs against local stand-ins for
+# HoYoLAB and enka.network, on a synthetic database.
+#
+#   python bench/jobs.py                                  10k users, every job
+#   python bench/jobs.py --users 100000 --jobs daily_rewards --claim-rate 1000
+#   python bench/jobs.py --latency-ms 300 --error-rate 0.05 --rate-limit 200
+#
+# Everything runs in a temporary directory, the real ganyu.db and settings.json
+# are never touched. The stand-in servers share the event loop with the jobs,
+# so very high rates measure this process as much as the jobs themselves.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+import yarl
+from aiohttp import web
+from genshin import types
+from genshin.client import routes
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+JOBS = ["daily_rewards", "daily_hsr_rewards", "activity_feed_update"]
+BASE_DISCORD_ID = 100000000000000000
+BASE_UID = 600000000
+BASE_HSR_UID = 700000000
+BASE_ALT_UID = 800000000
+
+
+class FakeUpstream:
+    # Latency, random errors and a token bucket rate limit shared by every
+    # request to one stand-in service
+    def __init__(self, latency, error_rate, rate_limit, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.random = random.Random(seed)
+        self.tokens = rate_limit
+        self.last_refill = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.limited = 0
+
+    def take_token(self):
+        if not self.rate_limit:
+            return True
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate_limit, self.tokens + (now - self.last_refill) * self.rate_limit
+        )
+        self.last_refill = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def respond(self):
+        # Returns "ok", "error" or "limited" after the simulated latency
+        self.requests += 1
+        await asyncio.sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if not self.take_token():
+            self.limited += 1
+            return "limited"
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return "error"
+        return "ok"
+
+
+def hoyolab_app(upstream, invalid_rate):
+    async def sign(request):
+        # Accounts with invalid cookies stay invalid for the whole run
+        cookies = ";".join(f"{k}={v}" for k, v in sorted(request.cookies.items()))
+        outcome = await upstream.respond()
+        if random.Random(cookies).random() < invalid_rate:
+            body = {"retcode": -100, "message": "Please login", "data": None}
+        elif outcome == "limited":
+            body = {"retcode": -110, "message": "Visits too frequently", "data": None}
+        elif outcome == "error":
+            body = {"retcode": -1, "message": "Bench error", "data": None}
+        else:
+            body = {"retcode": 0, "message": "OK", "data": {"code": "ok"}}
+        return web.json_response(body)
+
+    app = web.Application()
+    app.router.add_post("/event/{path:.+}/sign", sign)
+    return app
+
+
+def enka_app(upstream, change_rate):
+    # uid -> player info, bumped now and then so some polls log activity
+    players = {}
+
+    async def profile(request):
+        outcome = await upstream.respond()
+        if outcome == "limited":
+            return web.Response(status=429, text="Too many requests")
+        if outcome == "error":
+            return web.Response(status=500, text="Bench error")
+
+        uid = int(request.match_info["uid"])
+        player_info = players.setdefault(
+            uid,
+            {
+                "nickname": f"Bench {uid}",
+                "level": 50 + uid % 10,
+                "worldLevel": 7,
+                "finishAchievementNum": 500 + uid % 300,
+                "towerFloorIndex": 12,
+                "towerLevelIndex": 3,
+            },
+        )
+        if upstream.random.random() < change_rate:
+            player_info["finishAchievementNum"] += 1
+        return web.json_response({"playerInfo": player_info})
+
+    app = web.Application()
+    app.router.add_get("/api/uid/{uid}", profile)
+    return app
+
+
+async def start_app(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def redirect_upstreams(hoyolab_url, enka_url):
+    import enka
+
+    urls = routes.REWARD_URL.urls[types.Region.OVERSEAS]
+    for game, url in urls.items():
+        urls[game] = yarl.URL(hoyolab_url).with_path(url.path).with_query(url.query)
+    enka.ENKA_API_URL = f"{enka_url}/api/uid/{{uid}}?info"
+
+
+class LatencyRecorder:
+    # Time spent on each user: every claim(item) call the claim engine makes
+    # for them (a claim can take several requests, retries add more) or their
+    # enka fetch. Outgoing requests are counted separately, next to the bot's
+    # own trace configs.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.per_user = {}
+        self.requests = 0
+
+    def add(self, key, start_time):
+        self.per_user[key] = self.per_user.get(key, 0) + (
+            time.perf_counter() - start_time
+        )
+
+    async def on_request_start(self, session, context, params):
+        self.requests += 1
+
+    def install(self):
+        import net
+        import rewards
+        import singleflight
+        from claim_engine import ClaimEngine
+
+        trace_configs = net.trace_configs
+
+        def with_recorder():
+            config = aiohttp.TraceConfig()
+            config.on_request_start.append(self.on_request_start)
+            return trace_configs() + [config]
+
+        net.trace_configs = with_recorder
+
+        attempt = ClaimEngine.attempt
+
+        async def timed_attempt(engine, item, claim):
+            async def timed_claim(item):
+                start_time = time.perf_counter()
+                try:
+                    await claim(item)
+                finally:
+                    self.add(rewards.account_key(item), start_time)
+
+            return await attempt(engine, item, timed_claim)
+
+        ClaimEngine.attempt = timed_attempt
+
+        do = singleflight.do
+
+        async def timed_do(key, func, *args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await do(key, func, *args, **kwargs)
+            finally:
+                self.add(key, start_time)
+
+        singleflight.do = timed_do
+
+
+def seed_db(con, args):
+    now = int(time.time())
+    users = [
+        (
+            BASE_DISCORD_ID + i,
+            BASE_UID + i,
+            str(10000000 + i),
+            f"v2_bench_{i}",
+            True,
+            i < args.users * args.tracked,
+        )
+        for i in range(args.users)
+    ]
+    con.executemany(
+        "INSERT INTO user_data (discord_id, uid, ltuid, ltoken, daily_reward, track)"
+        " VALUES (?, ?, ?, ?, ?, ?)",
+        users,
+    )
+    con.executemany(
+        "INSERT INTO hsr_user_data (discord_id, uid, ltuid, ltoken, account_mid,"
+        " cookie_token, daily_reward) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                BASE_DISCORD_ID + i,
+                BASE_HSR_UID + i,
+                str(10000000 + i),
+                f"v2_bench_{i}",
+                f"mid_{i}",
+                f"v2_cookie_{i}",
+                True,
+            )
+            for i in range(args.hsr_users)
+        ],
+    )
+    con.executemany(
+        "INSERT INTO alt_data (id, name, uid, ltuid, ltoken) VALUES (?, ?, ?, ?, ?)",
+        [
+            (
+                str(uuid.uuid4()),
+                f"alt{i}",
+                BASE_ALT_UID + i,
+                str(20000000 + i),
+                f"v2_alt_{i}",
+            )
+            for i in range(args.alts)
+        ],
+    )
+    # one earlier snapshot per tracked user, like a bot that has been running
+    con.executemany(
+        "INSERT INTO user_activity (discord_id, level, world_level,"
+        " finish_achievement_num, tower_floor_index, tower_level_index, timestamp)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (user[0], 50 + user[1] % 10, 7, 500 + user[1] % 300, 12, 3, now - 3600)
+            for user in users
+            if user[5]
+        ],
+    )
+    con.commit()
+
+
+def percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    import adb
+    import db
+    import main
+    import metrics
+    import net
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    hoyolab = FakeUpstream(
+        args.latency_ms / 1000, args.error_rate, args.rate_limit, args.seed
+    )
+    enka_upstream = FakeUpstream(
+        args.latency_ms / 1000, args.error_rate, args.rate_limit, args.seed + 1
+    )
+    hoyolab_runner, hoyolab_url = await start_app(
+        hoyolab_app(hoyolab, args.invalid_rate)
+    )
+    enka_runner, enka_url = await start_app(enka_app(enka_upstream, args.change_rate))
+    redirect_upstreams(hoyolab_url, enka_url)
+    recorder = LatencyRecorder()
+    recorder.install()
+
+    start_time = time.perf_counter()
+    await adb.init("ganyu.db", write_behind=args.write_behind)
+    await adb.run(seed_db, db.con, args)
+    print(
+        f"Seeded {args.users} user(s), {args.hsr_users} HSR user(s), {args.alts} alt(s)"
+        f" in {time.perf_counter() - start_time:.1f}s"
+    )
+    main.enka_poller.configure(main.util.get_settings())
+
+    jobs = {
+        "daily_rewards": (main.auto_collect_daily_rewards, args.users + args.alts),
+        "daily_hsr_rewards": (main.auto_collect_hsr_daily_rewards, args.hsr_users),
+        "activity_feed_update": (main.poll_enka, int(args.users * args.tracked)),
+    }
+    results = []
+    for name in args.jobs:
+        job, users = jobs[name]
+        recorder.reset()
+        start_time = time.perf_counter()
+        await job()
+        await adb.flush()
+        wall_time = time.perf_counter() - start_time
+
+        latencies = sorted(recorder.per_user.values())
+        outcomes = {
+            key[1]: value
+            for key, value in metrics.JOB_ITEMS.values.items()
+            if key[0] == name
+        }
+        results.append(
+            {
+                "job": name,
+                "users": users,
+                "wall_time": wall_time,
+                "throughput": users / wall_time if wall_time else 0,
+                "requests": recorder.requests,
+                "p50_ms": percentile(latencies, 0.5) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                "outcomes": outcomes,
+            }
+        )
+
+    await net.close()
+    await hoyolab_runner.cleanup()
+    await enka_runner.cleanup()
+    await adb.run(db.close)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--hsr-users", type=int, default=None)
+    parser.add_argument("--alts", type=int, default=10)
+    parser.add_argument(
+        "--tracked", type=float, default=1.0, help="share of users in the activity feed"
+    )
+    parser.add_argument("--jobs", nargs="+", choices=JOBS, default=JOBS)
+    parser.add_argument("--latency-ms", type=float, default=150)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument(
+        "--invalid-rate",
+        type=float,
+        default=0.01,
+        help="share of accounts with dead cookies",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0,
+        help="requests per second per service, 0 for none",
+    )
+    parser.add_argument(
+        "--change-rate",
+        type=float,
+        default=0.1,
+        help="share of enka profiles that changed",
+    )
+    parser.add_argument("--claim-workers", type=int, default=64)
+    parser.add_argument("--claim-rate", type=float, default=200)
+    parser.add_argument("--enka-workers", type=int, default=64)
+    parser.add_argument("--enka-rate", type=float, default=400)
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    if args.hsr_users is None:
+        args.hsr_users = args.users // 2
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    work_dir = tempfile.mkdtemp(prefix="ganyu-bench-")
+    os.chdir(work_dir)
+    with open("settings.json", "w") as file:
+        json.dump(
+            {
+                "token": "bench",
+                "ganyu_mods": [],
+                "claim_workers": args.claim_workers,
+                "claim_rate": args.claim_rate,
+                "claim_max_rate": args.claim_rate,
+                "enka_workers": args.enka_workers,
+                "enka_rate": args.enka_rate,
+            },
+            file,
+        )
+
+    results = asyncio.run(run(args))
+
+    print(
+        f"\n{'job':<22}{'users':>8}{'wall s':>9}{'users/s':>10}{'requests':>10}"
+        f"{'user p50':>10}{'user p99':>10}  outcomes"
+    )
+    for result in results:
+        outcomes = ", ".join(f"{k} {v}" for k, v in sorted(result["outcomes"].items()))
+        print(
+            f"{result['job']:<22}{result['users']:>8}{result['wall_time']:>9.1f}"
+            f"{result['throughput']:>10.1f}{result['requests']:>10}"
+            f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}  {outcomes}"
+        )
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"args": vars(args), "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
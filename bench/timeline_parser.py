@@ -0,0 +1,132 @@
+# Compares timeline.parse_timeline against the old demjson based path.
+#
+#   python bench/timeline_parser.py --record         save the live paimon.moe bundle
+#   python bench/timeline_parser.py [bundle.js]      benchmark a recorded bundle
+#
+# Without a recorded bundle a synthetic one in the same minified shape is used.
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from datetime import datetime
+
+import demjson
+import pytz
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import timeline  # noqa: E402
+
+PAIMON_MOE_URL_BASE = "https://paimon.moe"
+TIMELINE_REGEX = "/_app/immutable/chunks/timeline-\\w+.js"
+DEFAULT_BUNDLE_PATH = os.path.join(os.path.dirname(__file__), "timeline_bundle.js")
+
+
+def legacy_parse_timeline(raw):
+    info = demjson.decode(raw[raw.index("[") : raw.index("];") + 1].replace("!0", "1"))
+    consolidated_event_list = []
+    for event_list in info:
+        for event in event_list:
+            try:
+                if event.get("timezoneDependent"):
+                    event["start"] = int(
+                        datetime.strptime(event["start"], "%Y-%m-%d %H:%M:%S")
+                        .replace(tzinfo=pytz.timezone("Etc/GMT-8"))
+                        .timestamp()
+                    )
+                else:
+                    event["start"] = int(
+                        datetime.strptime(event["start"], "%Y-%m-%d %H:%M:%S")
+                        .replace(tzinfo=pytz.timezone("Etc/GMT+5"))
+                        .timestamp()
+                    )
+
+                event["end"] = int(
+                    datetime.strptime(event["end"], "%Y-%m-%d %H:%M:%S")
+                    .replace(tzinfo=pytz.timezone("Etc/GMT+5"))
+                    .timestamp()
+                )
+                consolidated_event_list.append(event)
+            except Exception:
+                pass
+
+    return consolidated_event_list
+
+
+def record(path):
+    res = requests.get(f"{PAIMON_MOE_URL_BASE}/timeline/")
+    timeline_js = re.findall(TIMELINE_REGEX, res.text)[0]
+    res = requests.get(f"{PAIMON_MOE_URL_BASE}{timeline_js}")
+    with open(path, "w") as f:
+        f.write(res.text)
+    print(f"Recorded {timeline_js} ({len(res.text)} bytes) to {path}")
+
+
+def synthetic_bundle(groups=60, events_per_group=12):
+    rng = random.Random(0)
+    event_groups = []
+    for group in range(groups):
+        events = []
+        for i in range(events_per_group):
+            month = rng.randint(1, 12)
+            day = rng.randint(1, 20)
+            events.append(
+                f'{{name:"Event {group}-{i}",image:"event_{group}_{i}.png",'
+                f'start:"2024-{month:02}-{day:02} 10:00:00",'
+                f'end:"2024-{month:02}-{day + 7:02} 03:59:59",'
+                f'color:"#{rng.randint(0, 0xFFFFFF):06x}",'
+                f'url:"https://www.hoyolab.com/article/{rng.randint(10**6, 10**7)}",'
+                f"showOnHome:!0{',timezoneDependent:!0' if i % 3 == 0 else ''},"
+                f'description:"Complete \\"challenges\\" during the event period '
+                f'to obtain Primogems, Talent Level-Up Materials and other rewards."}}'
+            )
+        event_groups.append("[" + ",".join(events) + "]")
+
+    return f"const e=[{','.join(event_groups)}];export{{e as t}};"
+
+
+def measure(func, raw, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func(raw)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bundle", nargs="?", default=DEFAULT_BUNDLE_PATH)
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.bundle)
+        return
+
+    if os.path.exists(args.bundle):
+        with open(args.bundle) as f:
+            raw = f.read()
+        print(f"Using recorded bundle {args.bundle} ({len(raw)} bytes)")
+    else:
+        raw = synthetic_bundle()
+        print(f"No recorded bundle, using a synthetic one ({len(raw)} bytes)")
+
+    legacy_time, legacy_events = measure(legacy_parse_timeline, raw, args.rounds)
+    new_time, new_events = measure(timeline.parse_timeline, raw, args.rounds)
+
+    def key(event):
+        return event["name"], event["start"], event["end"]
+
+    assert sorted(map(key, legacy_events)) == sorted(map(key, new_events))
+    print(f"{len(new_events)} events")
+    print(f"demjson: {legacy_time * 1000:9.2f} ms")
+    print(f"timeline: {new_time * 1000:8.2f} ms ({legacy_time / new_time:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
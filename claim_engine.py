@@ -0,0 +1,193 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+from collections import deque
+
+import aiohttp
+from genshin.errors import (
+    GenshinException,
+    InternalDatabaseError,
+    TooManyRequests,
+    VisitsTooFrequently,
+)
+
+DEFAULT_CLAIM_WORKERS = 4
+DEFAULT_CLAIM_RATE = 2.0  # claims per second across all workers
+MIN_CLAIM_RATE = 0.2
+MAX_CLAIM_RATE = 10.0
+DEFAULT_CLAIM_RETRIES = 3
+DEFAULT_RETRY_DELAY = 5.0  # seconds before the first retry, doubled after each
+
+# Worth trying again later in the same run; anything else (dead cookies, no
+# game account, geetest...) fails the same way until the user does something
+TRANSIENT_ERRORS = (
+    InternalDatabaseError,
+    TooManyRequests,
+    VisitsTooFrequently,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+def is_transient(error):
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class AdaptiveRateController:
+    # Speeds up additively while healthy, backs off multiplicatively once the
+    # recent error ratio crosses the threshold (a few flaky requests shouldn't
+    # slow everyone down)
+    def __init__(
+        self,
+        rate=DEFAULT_CLAIM_RATE,
+        min_rate=MIN_CLAIM_RATE,
+        max_rate=MAX_CLAIM_RATE,
+        increase=0.1,
+        backoff=0.7,
+        window=20,
+        error_threshold=0.25,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.backoff = backoff
+        self.error_threshold = error_threshold
+        self.outcomes = deque(maxlen=window)
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        # Hand out evenly spaced slots; no awaits between the read and the
+        # write, so concurrent workers never grab the same slot
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def error_ratio(self):
+        if not self.outcomes:
+            return 0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def on_success(self):
+        self.outcomes.append(True)
+        if self.error_ratio() <= self.error_threshold:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_error(self):
+        self.outcomes.append(False)
+        if self.error_ratio() > self.error_threshold:
+            self.rate = max(self.min_rate, self.rate * self.backoff)
+
+
+class ClaimEngine:
+    def __init__(
+        self,
+        workers=DEFAULT_CLAIM_WORKERS,
+        rate_controller=None,
+        retries=DEFAULT_CLAIM_RETRIES,
+        retry_delay=DEFAULT_RETRY_DELAY,
+    ):
+        self.workers = max(1, workers)
+        self.rate_controller = rate_controller or AdaptiveRateController()
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    @classmethod
+    def from_settings(cls, settings, shards=1):
+        # The configured rates are for the whole run, each of shards
+        # processes gets its share
+        return cls(
+            workers=settings.get("claim_workers", DEFAULT_CLAIM_WORKERS),
+            rate_controller=AdaptiveRateController(
+                rate=settings.get("claim_rate", DEFAULT_CLAIM_RATE) / shards,
+                min_rate=MIN_CLAIM_RATE / shards,
+                max_rate=settings.get("claim_max_rate", MAX_CLAIM_RATE) / shards,
+            ),
+            retries=settings.get("claim_retries", DEFAULT_CLAIM_RETRIES),
+            retry_delay=settings.get("claim_retry_delay", DEFAULT_RETRY_DELAY),
+        )
+
+    def backoff(self, attempt):
+        # Exponential with jitter so retries of one bad minute spread out
+        return self.retry_delay * 2**attempt * random.uniform(0.5, 1.5)
+
+    def should_retry(self, error, attempt):
+        return error is not None and is_transient(error) and attempt < self.retries
+
+    async def attempt(self, item, claim):
+        # One rate limited claim(item), returns the error or None if it went
+        # through
+        await self.rate_controller.acquire()
+        error = None
+        try:
+            await claim(item)
+        except GenshinException as e:
+            error = e
+        except Exception as e:
+            error = e
+            if not is_transient(e):
+                logging.exception("Unexpected error while claiming daily reward")
+
+        # Only transient errors say anything about HoYoLAB's health, dead
+        # cookies shouldn't slow everyone else down
+        if error is not None and is_transient(error):
+            self.rate_controller.on_error()
+        else:
+            self.rate_controller.on_success()
+        return error
+
+    async def run(self, items, claim, on_result=None):
+        # Runs claim(item) for every item, returns (succeeded, failed) lists.
+        # Transient errors are retried with backoff up to self.retries times
+        # before counting as failed. on_result(item, error) is awaited once per
+        # item if given, error being None when the claim went through.
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait((0, item))
+        # (due, seq, attempt, item), seq keeps items from being compared
+        retries = []
+        seq = itertools.count()
+
+        succeeded = []
+        failed = []
+
+        async def worker():
+            while True:
+                if not queue.empty():
+                    attempt, item = queue.get_nowait()
+                elif retries:
+                    due, _, attempt, item = heapq.heappop(retries)
+                    await asyncio.sleep(max(0, due - time.monotonic()))
+                else:
+                    return
+
+                error = await self.attempt(item, claim)
+                if self.should_retry(error, attempt):
+                    due = time.monotonic() + self.backoff(attempt)
+                    heapq.heappush(retries, (due, next(seq), attempt + 1, item))
+                    continue
+                if error is None:
+                    succeeded.append(item)
+                else:
+                    failed.append(item)
+
+                if on_result:
+                    await on_result(item, error)
+
+        tasks = [
+            asyncio.create_task(worker()) for _ in range(min(self.workers, len(items)))
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # A worker that raised (e.g. a failed checkpoint write) stops the
+            # rest, they'd keep claiming with nothing recording it
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return succeeded, failed
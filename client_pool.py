@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+import aiohttp
+from genshin.client.manager import CookieManager
+
+import net
+
+DEFAULT_MAX_CLIENTS = 1024
+DEFAULT_IDLE_TIMEOUT = 1800  # 30 min
+
+
+# Sessions borrow the shared connector so repeat calls reuse warm keep-alive
+# connections instead of paying for a fresh session + TLS handshake
+class PooledCookieManager(CookieManager):
+    def create_session(self, **kwargs):
+        return aiohttp.ClientSession(
+            connector=net.get_connector(),
+            connector_owner=False,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trace_configs=net.trace_configs(),
+            **kwargs,
+        )
+
+
+class ClientPool:
+    def __init__(self, max_size=DEFAULT_MAX_CLIENTS, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # key -> [client, last used], least recently used first
+        self.clients = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, factory):
+        now = time.monotonic()
+        self.evict_idle(now)
+
+        entry = self.clients.get(key)
+        if entry:
+            self.hits += 1
+            entry[1] = now
+            self.clients.move_to_end(key)
+            return entry[0]
+
+        self.misses += 1
+        client = factory()
+        client.cookie_manager = PooledCookieManager(client.cookie_manager.cookies)
+        self.clients[key] = [client, now]
+        while len(self.clients) > self.max_size:
+            self.clients.popitem(last=False)
+            self.evictions += 1
+
+        return client
+
+    def evict_idle(self, now=None):
+        now = now or time.monotonic()
+        while self.clients:
+            key, (client, last_used) = next(iter(self.clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self.clients[key]
+            self.evictions += 1
+
+    def discard(self, key):
+        self.clients.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.clients),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0,
+        }
+
+
+pool = ClientPool()
@@ -1,17 +1,137 @@
+import json
 import sqlite3
 import uuid
 import time
+from cachetools import LRUCache
 from util import dict_factory
 
 cur = None
 con = None
 default_path = "ganyu.db"
 
-
-def init(path=default_path):
-    global con
-    con = sqlite3.connect(path)
+WRITE_BEHIND_MAX_PENDING = 500
+WRITE_BEHIND_MAX_DELAY = 5  # seconds
+write_behind_enabled = False
+# suspend_write_behind() calls not yet resumed, writes commit right away
+write_behind_holds = 0
+pending_writes = 0
+last_flush = time.monotonic()
+
+# discord_id -> user_data / hsr_user_data row (None if not linked), the
+# setters below drop entries they touch
+LINK_CACHE_SIZE = 4096
+MISSING = object()
+link_cache = LRUCache(maxsize=LINK_CACHE_SIZE)
+hsr_link_cache = LRUCache(maxsize=LINK_CACHE_SIZE)
+link_cache_hits = 0
+link_cache_misses = 0
+
+
+ACTIVITY_FIELDS = {
+    "level": "level",
+    "world_level": "worldLevel",
+    "finish_achievement_num": "finishAchievementNum",
+    "tower_floor_index": "towerFloorIndex",
+    "tower_level_index": "towerLevelIndex",
+}
+
+
+# Each entry upgrades the schema by one version (tracked in PRAGMA user_version),
+# never edit an entry that has shipped, append a new one instead
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS user_data (discord_id INT CONSTRAINT user_data_pk"
+        " PRIMARY KEY, uid INT, ltuid TEXT, ltoken TEXT, daily_reward BOOLEAN DEFAULT"
+        " FALSE, account_id TEXT, cookie_token TEXT, track BOOLEAN DEFAULT TRUE)",
+        "CREATE TABLE IF NOT EXISTS hsr_user_data (discord_id INT PRIMARY KEY, uid INT,"
+        " ltuid TEXT, ltoken TEXT, account_mid TEXT, cookie_token TEXT,"
+        " daily_reward BOOLEAN DEFAULT FALSE)",
+        "CREATE TABLE IF NOT EXISTS alt_data (id TEXT PRIMARY KEY, name TEXT, uid INT,"
+        " ltuid TEXT, ltoken TEXT)",
+        "CREATE TABLE IF NOT EXISTS user_activity (discord_id INT, level INT,"
+        " world_level INT, finish_achievement_num INT, tower_floor_index INT,"
+        " tower_level_index INT, `timestamp` INTEGER,"
+        " FOREIGN KEY(discord_id) REFERENCES user_data(discord_id))",
+        "CREATE TABLE IF NOT EXISTS activity_heartbeat "
+        "(discord_id INT PRIMARY KEY, last_seen INTEGER)",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS user_data_uid ON user_data (uid)",
+        "CREATE INDEX IF NOT EXISTS hsr_user_data_uid ON hsr_user_data (uid)",
+        "CREATE INDEX IF NOT EXISTS alt_data_uid ON alt_data (uid)",
+        "CREATE INDEX IF NOT EXISTS user_activity_discord_id_timestamp"
+        " ON user_activity (discord_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS user_activity_timestamp ON user_activity (timestamp)",
+        "CREATE INDEX IF NOT EXISTS user_data_daily_reward ON user_data (discord_id)"
+        " WHERE daily_reward = TRUE",
+        "CREATE INDEX IF NOT EXISTS user_data_track ON user_data (discord_id)"
+        " WHERE track = TRUE",
+        "CREATE INDEX IF NOT EXISTS hsr_user_data_daily_reward"
+        " ON hsr_user_data (discord_id) WHERE daily_reward = TRUE",
+        "ANALYZE",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS shard_reports (run_id TEXT, shard INT,"
+        " job TEXT, total INT, claimed INT, failed TEXT, updated INTEGER,"
+        " finished INTEGER, PRIMARY KEY (run_id, shard))",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS reward_runs (run_id TEXT PRIMARY KEY, job TEXT,"
+        " reward_day TEXT, started INTEGER, finished INTEGER)",
+        "CREATE INDEX IF NOT EXISTS reward_runs_job_day ON reward_runs (job, reward_day)",
+        "CREATE TABLE IF NOT EXISTS reward_checkpoints (run_id TEXT, account TEXT,"
+        " outcome TEXT, label TEXT, `timestamp` INTEGER, PRIMARY KEY (run_id, account))",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS claim_ledger (account TEXT, game TEXT,"
+        " reward_day TEXT, outcome TEXT, `timestamp` INTEGER,"
+        " PRIMARY KEY (game, reward_day, account))",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS quarantine (account TEXT, game TEXT, reason TEXT,"
+        " `timestamp` INTEGER, PRIMARY KEY (game, account))",
+    ],
+    ["ALTER TABLE shard_reports ADD COLUMN skipped INT DEFAULT 0"],
+    ["ALTER TABLE shard_reports ADD COLUMN quarantined INT DEFAULT 0"],
+    # quarantine is keyed by ltuid and cookies now, the old entries get one
+    # more try and are quarantined again if still invalid
+    ["DELETE FROM quarantine"],
+]
+
+
+def init(path=default_path, write_behind=False):
+    global con, write_behind_enabled
+    # An earlier connection may still hold write-behind writes
+    close()
+    # Queries are serialized on adb's executor thread, but the exit-time
+    # flush runs on the main thread
+    con = sqlite3.connect(path, check_same_thread=False)
     con.row_factory = dict_factory
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA busy_timeout = 5000")
+    con.execute("PRAGMA cache_size = -16000")  # 16 MB
+    con.execute("PRAGMA temp_store = MEMORY")
+    migrate()
+    write_behind_enabled = write_behind
+    link_cache.clear()
+    hsr_link_cache.clear()
+
+
+def migrate():
+    version = con.execute("PRAGMA user_version").fetchone()["user_version"]
+    for target_version in range(version + 1, len(MIGRATIONS) + 1):
+        # The statements and the version bump commit together, a crash in
+        # between would replay an ALTER TABLE on every later start
+        con.execute("BEGIN")
+        try:
+            for statement in MIGRATIONS[target_version - 1]:
+                con.execute(statement)
+            con.execute(f"PRAGMA user_version = {target_version}")
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
 
 
 def get_cursor():
@@ -20,6 +140,50 @@ def get_cursor():
     return con.cursor()
 
 
+def commit():
+    # In write-behind mode writes pile up in one open transaction and are
+    # committed together once enough are pending or the oldest is too old
+    global pending_writes
+    if not write_behind_enabled or write_behind_holds:
+        con.commit()
+        return
+
+    pending_writes += 1
+    if (
+        pending_writes >= WRITE_BEHIND_MAX_PENDING
+        or time.monotonic() - last_flush >= WRITE_BEHIND_MAX_DELAY
+    ):
+        flush()
+
+
+def flush():
+    global pending_writes, last_flush
+    if con:
+        con.commit()
+    pending_writes = 0
+    last_flush = time.monotonic()
+
+
+def suspend_write_behind():
+    global write_behind_holds
+    flush()
+    write_behind_holds += 1
+
+
+def resume_write_behind():
+    global write_behind_holds
+    write_behind_holds = max(0, write_behind_holds - 1)
+
+
+def close():
+    # Closing the last connection also checkpoints the WAL back into the db file
+    global con
+    flush()
+    if con:
+        con.close()
+        con = None
+
+
 def update_link_entry(discord_id, uid, ltuid, ltoken, daily_reward=True):
     get_cursor().execute(
         "INSERT INTO user_data VALUES (?, ?, ?, ?, ?, NULL, NULL, TRUE) on conflict(discord_id) do"
@@ -27,7 +191,9 @@ def update_link_entry(discord_id, uid, ltuid, ltoken, daily_reward=True):
         "daily_reward = excluded.daily_reward",
         (discord_id, uid, ltuid, ltoken, daily_reward),
     )
-    con.commit()
+    release_account(ltuid, "genshin")
+    commit()
+    link_cache.pop(discord_id, None)
 
 
 def update_hsr_link_entry(
@@ -39,7 +205,9 @@ def update_hsr_link_entry(
         "daily_reward = excluded.daily_reward",
         (discord_id, uid, ltuid, ltoken, account_mid, cookie_token, daily_reward),
     )
-    con.commit()
+    release_account(ltuid, "hsr")
+    commit()
+    hsr_link_cache.pop(discord_id, None)
 
 
 def create_alt_entry(name, uid, ltuid, ltoken):
@@ -47,12 +215,13 @@ def create_alt_entry(name, uid, ltuid, ltoken):
         "INSERT INTO alt_data VALUES (?, ?, ?, ?, ?)",
         (str(uuid.uuid4()), name, uid, ltuid, ltoken),
     )
-    con.commit()
+    release_account(ltuid, "genshin")
+    commit()
 
 
 def delete_alt_entry(uuid):
     get_cursor().execute("DELETE FROM alt_data WHERE id = :id", {"id": uuid})
-    con.commit()
+    commit()
 
 
 def get_alt_data(uuid):
@@ -89,7 +258,8 @@ def set_account_id(discord_id, uid):
         "UPDATE user_data SET account_id = :value WHERE discord_id = :discord_id",
         {"value": uid, "discord_id": discord_id},
     )
-    con.commit()
+    commit()
+    link_cache.pop(discord_id, None)
 
 
 def set_cookie_token(discord_id, cookie_token):
@@ -97,7 +267,8 @@ def set_cookie_token(discord_id, cookie_token):
         "UPDATE user_data SET cookie_token = :value WHERE discord_id = :discord_id",
         {"value": cookie_token, "discord_id": discord_id},
     )
-    con.commit()
+    commit()
+    link_cache.pop(discord_id, None)
 
 
 def set_daily_reward(discord_id, value):
@@ -105,15 +276,17 @@ def set_daily_reward(discord_id, value):
         "UPDATE user_data SET daily_reward = :value WHERE discord_id = :discord_id",
         {"value": value, "discord_id": discord_id},
     )
-    con.commit()
+    commit()
+    link_cache.pop(discord_id, None)
 
 
 def set_hsr_daily_reward(discord_id, value):
     get_cursor().execute(
-        "UPDATE user_data SET daily_reward = :value WHERE discord_id = :discord_id",
+        "UPDATE hsr_user_data SET daily_reward = :value WHERE discord_id = :discord_id",
         {"value": value, "discord_id": discord_id},
     )
-    con.commit()
+    commit()
+    hsr_link_cache.pop(discord_id, None)
 
 
 def set_activity_tracking(discord_id, value):
@@ -121,37 +294,50 @@ def set_activity_tracking(discord_id, value):
         "UPDATE user_data SET track = :value WHERE discord_id = :discord_id",
         {"value": value, "discord_id": discord_id},
     )
-    con.commit()
-
-
-def get_link_entry(discord_id):
-    data = (
-        get_cursor()
-        .execute(
-            "SELECT * FROM user_data WHERE discord_id = :discord_id",
-            {"discord_id": discord_id},
+    commit()
+    link_cache.pop(discord_id, None)
+
+
+def cached_link_lookup(cache, table, discord_id):
+    global link_cache_hits, link_cache_misses
+    data = cache.get(discord_id, MISSING)
+    if data is MISSING:
+        link_cache_misses += 1
+        data = (
+            get_cursor()
+            .execute(
+                f"SELECT * FROM {table} WHERE discord_id = :discord_id",
+                {"discord_id": discord_id},
+            )
+            .fetchone()
         )
-        .fetchone()
-    )
+        cache[discord_id] = data
+    else:
+        link_cache_hits += 1
+
+    # callers modify the records they get back, hand out copies
     if data:
-        return data
+        return dict(data)
 
     return None
 
 
+def get_link_entry(discord_id):
+    return cached_link_lookup(link_cache, "user_data", discord_id)
+
+
 def get_hsr_link_entry(discord_id):
-    data = (
-        get_cursor()
-        .execute(
-            "SELECT * FROM hsr_user_data WHERE discord_id = :discord_id",
-            {"discord_id": discord_id},
-        )
-        .fetchone()
-    )
-    if data:
-        return data
+    return cached_link_lookup(hsr_link_cache, "hsr_user_data", discord_id)
 
-    return None
+
+def link_cache_stats():
+    lookups = link_cache_hits + link_cache_misses
+    return {
+        "size": len(link_cache) + len(hsr_link_cache),
+        "hits": link_cache_hits,
+        "misses": link_cache_misses,
+        "hit_ratio": link_cache_hits / lookups if lookups else 0,
+    }
 
 
 def get_all_auto_checkin_users():
@@ -181,7 +367,7 @@ def get_latest_activity(discord_id):
     data = (
         get_cursor()
         .execute(
-            "SELECT * FROM user_activity WHERE discord_id = :discord_id ORDER BY timestamp DESC limit 1",
+            "SELECT * FROM user_activity WHERE discord_id = :discord_id ORDER BY timestamp DESC, rowid DESC limit 1",
             {"discord_id": discord_id},
         )
         .fetchone()
@@ -189,6 +375,20 @@ def get_latest_activity(discord_id):
     return data
 
 
+def get_latest_tracked_activities():
+    # discord_id -> latest snapshot for every tracked user, in one query
+    data = (
+        get_cursor()
+        .execute(
+            "SELECT a.* FROM user_data u JOIN user_activity a ON a.rowid ="
+            " (SELECT rowid FROM user_activity WHERE discord_id = u.discord_id"
+            " ORDER BY timestamp DESC, rowid DESC LIMIT 1) WHERE u.track = TRUE"
+        )
+        .fetchall()
+    )
+    return {activity["discord_id"]: activity for activity in data}
+
+
 def uid_exists(uid):
     data = (
         get_cursor()
@@ -219,7 +419,8 @@ def delete_entry_by_uid(uid):
     )
 
     get_cursor().execute("DELETE FROM user_data WHERE uid = :uid", {"uid": uid})
-    con.commit()
+    commit()
+    link_cache.pop(discord_id, None)
 
     return discord_id
 
@@ -232,7 +433,8 @@ def hsr_delete_entry_by_uid(uid):
     )
 
     get_cursor().execute("DELETE FROM hsr_user_data WHERE uid = :uid", {"uid": uid})
-    con.commit()
+    commit()
+    hsr_link_cache.pop(discord_id, None)
 
     return discord_id
 
@@ -246,24 +448,260 @@ def user_count():
     return data
 
 
-def log_activity(discord_id, enka_response):
+def get_last_seen(discord_id):
+    data = (
+        get_cursor()
+        .execute(
+            "SELECT last_seen FROM activity_heartbeat WHERE discord_id = :discord_id",
+            {"discord_id": discord_id},
+        )
+        .fetchone()
+    )
+    if data:
+        return data["last_seen"]
+
+    return None
+
+
+def log_activity(discord_id, enka_response, latest_activities=None):
+    # Only transitions are stored; every poll just bumps the heartbeat.
+    # latest_activities (from get_latest_tracked_activities) saves the lookup
+    # and is kept up to date with the new snapshot
     player_info = enka_response["playerInfo"]
+    timestamp = int(time.time())
+    if latest_activities is None:
+        last_activity = get_latest_activity(discord_id)
+    else:
+        last_activity = latest_activities.get(discord_id)
+
+    if not last_activity or any(
+        last_activity[column] != player_info[key]
+        for column, key in ACTIVITY_FIELDS.items()
+    ):
+        activity = {
+            "discord_id": discord_id,
+            **{column: player_info[key] for column, key in ACTIVITY_FIELDS.items()},
+            "timestamp": timestamp,
+        }
+        get_cursor().execute(
+            "INSERT INTO user_activity VALUES (:discord_id, :level, :world_level,"
+            " :finish_achievement_num, :tower_floor_index, :tower_level_index,"
+            " :timestamp)",
+            activity,
+        )
+        if latest_activities is not None:
+            latest_activities[discord_id] = activity
+
+    get_cursor().execute(
+        "INSERT INTO activity_heartbeat VALUES (?, ?) on conflict(discord_id) do"
+        " UPDATE SET last_seen = excluded.last_seen",
+        (discord_id, timestamp),
+    )
+    commit()
+
+
+def compact_activities():
+    # Drops rows left over from before change-only storage that repeat the
+    # previous snapshot for the same user
+    unchanged = " AND ".join(f"{column} IS prev_{column}" for column in ACTIVITY_FIELDS)
+    previous = ", ".join(
+        f"LAG({column}) OVER w AS prev_{column}" for column in ACTIVITY_FIELDS
+    )
     get_cursor().execute(
-        "INSERT INTO user_activity VALUES (?, ?, ?, ?, ?, ?, ?)",
+        "DELETE FROM user_activity WHERE rowid IN ("
+        f"SELECT rowid FROM (SELECT *, rowid, {previous} FROM user_activity"
+        " WINDOW w AS (PARTITION BY discord_id ORDER BY timestamp))"
+        f" WHERE {unchanged})"
+    )
+    commit()
+
+
+def purge_activities():
+    compact_activities()
+    # Keep each user's latest snapshot no matter how old, it's what new polls
+    # are diffed against
+    time_thres = int(time.time()) - (86400 * 30)
+    get_cursor().execute(
+        f"DELETE FROM user_activity WHERE timestamp < {time_thres} AND rowid NOT IN"
+        " (SELECT rowid FROM user_activity a WHERE timestamp ="
+        " (SELECT MAX(timestamp) FROM user_activity b WHERE b.discord_id = a.discord_id))"
+    )
+    commit()
+
+
+def save_shard_report(
+    run_id,
+    shard,
+    job,
+    total,
+    claimed,
+    failed,
+    finished=False,
+    skipped=0,
+    quarantined=0,
+):
+    # failed is {"users": [discord ids], "alts": [alt names]}
+    now = int(time.time())
+    get_cursor().execute(
+        "INSERT INTO shard_reports (run_id, shard, job, total, claimed, failed,"
+        " updated, finished, skipped, quarantined)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+        " on conflict(run_id, shard) do UPDATE SET total = excluded.total,"
+        " claimed = excluded.claimed, failed = excluded.failed,"
+        " updated = excluded.updated, finished = excluded.finished,"
+        " skipped = excluded.skipped, quarantined = excluded.quarantined",
         (
-            discord_id,
-            player_info["level"],
-            player_info["worldLevel"],
-            player_info["finishAchievementNum"],
-            player_info["towerFloorIndex"],
-            player_info["towerLevelIndex"],
-            int(time.time()),
+            run_id,
+            shard,
+            job,
+            total,
+            claimed,
+            json.dumps(failed),
+            now,
+            now if finished else None,
+            skipped,
+            quarantined,
         ),
     )
+    # read by the gateway process, so never left in a write-behind batch
     con.commit()
 
 
-def purge_activities():
-    time_thres = int(time.time()) - (86400 * 30)
-    get_cursor().execute(f"DELETE FROM user_activity WHERE timestamp < {time_thres}")
+def get_shard_reports(run_id):
+    data = (
+        get_cursor()
+        .execute(
+            "SELECT * FROM shard_reports WHERE run_id = :run_id ORDER BY shard",
+            {"run_id": run_id},
+        )
+        .fetchall()
+    )
+    for report in data:
+        report["failed"] = json.loads(report["failed"])
+    return data
+
+
+def create_reward_run(job, reward_day):
+    run_id = uuid.uuid4().hex
+    get_cursor().execute(
+        "INSERT INTO reward_runs VALUES (?, ?, ?, ?, NULL)",
+        (run_id, job, reward_day, int(time.time())),
+    )
+    con.commit()
+    return run_id
+
+
+def get_open_reward_runs(reward_day, job=None):
+    query = "SELECT * FROM reward_runs WHERE reward_day = ? AND finished IS NULL"
+    params = [reward_day]
+    if job:
+        query += " AND job = ?"
+        params.append(job)
+    return get_cursor().execute(query + " ORDER BY started DESC", params).fetchall()
+
+
+def finish_reward_run(run_id):
+    get_cursor().execute(
+        "UPDATE reward_runs SET finished = ? WHERE run_id = ?",
+        (int(time.time()), run_id),
+    )
+    con.commit()
+
+
+def save_reward_checkpoint(run_id, account, outcome, label):
+    get_cursor().execute(
+        "INSERT INTO reward_checkpoints VALUES (?, ?, ?, ?, ?) on conflict(run_id,"
+        " account) do UPDATE SET outcome = excluded.outcome,"
+        " timestamp = excluded.timestamp",
+        (run_id, account, outcome, label, int(time.time())),
+    )
+    # not batched, a lost checkpoint means claiming the account again
     con.commit()
+
+
+def get_reward_checkpoints(run_id):
+    return (
+        get_cursor()
+        .execute(
+            "SELECT account, outcome, label FROM reward_checkpoints WHERE run_id = ?",
+            (run_id,),
+        )
+        .fetchall()
+    )
+
+
+def purge_reward_runs():
+    # Checkpoints only matter until the reward day is over
+    time_thres = int(time.time()) - (86400 * 7)
+    old_runs = "SELECT run_id FROM reward_runs WHERE started < ?"
+    cursor = get_cursor()
+    cursor.execute(
+        f"DELETE FROM reward_checkpoints WHERE run_id IN ({old_runs})", (time_thres,)
+    )
+    cursor.execute(
+        f"DELETE FROM shard_reports WHERE run_id IN ({old_runs})", (time_thres,)
+    )
+    cursor.execute("DELETE FROM reward_runs WHERE started < ?", (time_thres,))
+    cursor.execute("DELETE FROM claim_ledger WHERE timestamp < ?", (time_thres,))
+    commit()
+
+
+def record_claim(account, game, reward_day, outcome):
+    # First outcome of the day wins, "already_claimed" after our own claim
+    # shouldn't overwrite it
+    get_cursor().execute(
+        "INSERT INTO claim_ledger VALUES (?, ?, ?, ?, ?) on conflict(game, reward_day,"
+        " account) do nothing",
+        (account, game, reward_day, outcome, int(time.time())),
+    )
+    # not batched, a lost entry means claiming the account again
+    con.commit()
+
+
+def get_claim(account, game, reward_day):
+    return (
+        get_cursor()
+        .execute(
+            "SELECT * FROM claim_ledger WHERE account = ? AND game = ? AND reward_day = ?",
+            (account, game, reward_day),
+        )
+        .fetchone()
+    )
+
+
+def get_claimed_accounts(game, reward_day):
+    data = (
+        get_cursor()
+        .execute(
+            "SELECT account FROM claim_ledger WHERE game = ? AND reward_day = ?",
+            (game, reward_day),
+        )
+        .fetchall()
+    )
+    return {row["account"] for row in data}
+
+
+def quarantine_account(account, game, reason):
+    get_cursor().execute(
+        "INSERT INTO quarantine VALUES (?, ?, ?, ?) on conflict(game, account) do"
+        " UPDATE SET reason = excluded.reason, timestamp = excluded.timestamp",
+        (account, game, reason, int(time.time())),
+    )
+    commit()
+
+
+def release_account(ltuid, game):
+    # Relinking is the only way out, releases every set of cookies ltuid was
+    # quarantined with. The caller commits
+    get_cursor().execute(
+        "DELETE FROM quarantine WHERE account LIKE ? AND game = ?", (f"{ltuid}:%", game)
+    )
+
+
+def get_quarantined_accounts(game):
+    data = (
+        get_cursor()
+        .execute("SELECT account FROM quarantine WHERE game = ?", (game,))
+        .fetchall()
+    )
+    return {row["account"] for row in data}
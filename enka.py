@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+import traceback
+
+import net
+import singleflight
+from claim_engine import AdaptiveRateController
+
+ENKA_API_URL = "https://enka.network/api/uid/{uid}?info"
+DEFAULT_ENKA_WORKERS = 16
+DEFAULT_ENKA_RATE = 20.0  # requests per second across all workers
+
+
+class EnkaPoller:
+    def __init__(self, workers=DEFAULT_ENKA_WORKERS, rate=DEFAULT_ENKA_RATE):
+        self.workers = workers
+        self.rate_controller = AdaptiveRateController(rate=rate, max_rate=rate)
+        # uid -> unix time when enka's cached copy of the profile expires
+        self.expires = {}
+        self.last_pass = None
+
+    def configure(self, settings):
+        self.workers = max(1, settings.get("enka_workers", DEFAULT_ENKA_WORKERS))
+        rate = settings.get("enka_rate", DEFAULT_ENKA_RATE)
+        self.rate_controller.max_rate = rate
+        self.rate_controller.rate = min(self.rate_controller.rate, rate)
+
+    async def fetch(self, uid):
+        await self.rate_controller.acquire()
+        try:
+            enka_data = await singleflight.do(
+                ("enka", uid), net.get_json, ENKA_API_URL.format(uid=uid)
+            )
+            enka_data["playerInfo"]
+        except Exception:
+            self.rate_controller.on_error()
+            raise
+
+        self.rate_controller.on_success()
+        if enka_data.get("ttl"):
+            self.expires[uid] = time.time() + enka_data["ttl"]
+
+        return enka_data
+
+    async def run(self, users, process):
+        # Calls process(user, enka_data) for every user whose enka data may
+        # have changed since the last fetch
+        start_time = time.monotonic()
+        now = time.time()
+        due = [user for user in users if self.expires.get(user["uid"], 0) <= now]
+
+        queue = asyncio.Queue()
+        for user in due:
+            queue.put_nowait(user)
+
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            while not queue.empty():
+                user = queue.get_nowait()
+                try:
+                    enka_data = await self.fetch(user["uid"])
+                    await process(user, enka_data)
+                except Exception:
+                    errors += 1
+                    logging.info(
+                        f"Error while fetching enka data for uid {user['uid']}; skipping"
+                    )
+                    traceback.print_exc()
+
+        await asyncio.gather(*[worker() for _ in range(min(self.workers, len(due)))])
+
+        self.last_pass = {
+            "users": len(users),
+            "fetched": len(due),
+            "skipped": len(users) - len(due),
+            "errors": errors,
+            "duration": time.monotonic() - start_time,
+            "finished": int(time.time()),
+        }
+        logging.info(
+            f"Enka poll: fetched {len(due)}/{len(users)} user(s)"
+            f" ({len(users) - len(due)} cached, {errors} error(s))"
+            f" in {self.last_pass['duration']:.1f}s"
+        )
+        return self.last_pass
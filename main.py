@@ -1,32 +1,38 @@
-import asyncio
+import atexit
 import datetime
 import logging
 import re
 import time
-import random
 
 import genshin
 import nextcord
 import pytz
-import requests
 from nextcord import Interaction
 from nextcord.ext import commands
+from apscheduler.events import EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_SUBMITTED
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import traceback
+import adb
+import client_pool
 import db
+import metrics
+import net
+import response_cache
+import rewards
+import slots
+import tracing
 from diskcache import Cache
 
 import util
 from genshin.client import MultiCookieClient, Client
 from genshin.errors import (
     InvalidCookies,
-    GenshinException,
-    AlreadyClaimed,
     DataNotPublic,
     RedemptionInvalid,
     RedemptionClaimed,
     RedemptionCooldown,
 )
+from enka import EnkaPoller
 from util import (
     create_activity_update_embed,
     create_message_embed,
@@ -36,7 +42,7 @@ from util import (
     ProfileChoices,
     create_reward_embed,
     create_status_embed,
-    MessageBook,
+    LazyMessageBook,
     get_client,
     get_hsr_client,
 )
@@ -47,7 +53,39 @@ logging.getLogger().setLevel(logging.INFO)
 bot = commands.Bot(command_prefix="!", intents=nextcord.Intents.all())
 bot.remove_command("help")
 cache = None
+started = False
 scheduler = AsyncIOScheduler(timezone="UTC")
+scheduler.add_listener(metrics.on_job_submitted, EVENT_JOB_SUBMITTED)
+scheduler.add_listener(metrics.on_job_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+enka_poller = EnkaPoller()
+metrics.register_cache("client_pool", client_pool.pool.stats)
+metrics.register_cache("linked_users", db.link_cache_stats)
+metrics.register_cache("responses", response_cache.stats)
+
+
+@bot.application_command_before_invoke
+async def before_command(interaction: Interaction):
+    interaction.attached.start_time = time.perf_counter()
+    interaction.attached.trace = tracing.begin(
+        f"command.{interaction.application_command.qualified_name}"
+    )
+
+
+@bot.application_command_after_invoke
+async def after_command(interaction: Interaction):
+    tracing.end(*interaction.attached.trace, interaction.attached.get("error"))
+    metrics.COMMAND_DURATION.observe(
+        time.perf_counter() - interaction.attached.start_time,
+        command=interaction.application_command.qualified_name,
+    )
+
+
+@bot.event
+async def on_application_command_error(interaction: Interaction, error):
+    metrics.COMMAND_ERRORS.inc(command=interaction.application_command.qualified_name)
+    # runs before after_command, which ends the trace with it
+    interaction.attached.error = getattr(error, "original", error)
+    traceback.print_exception(type(error), error, error.__traceback__)
 
 
 @bot.slash_command(name="ping", description="Pong!")
@@ -91,7 +129,7 @@ async def link(interaction: Interaction, ltuid: str, ltoken: str):
             discord_id = interaction.user.id
             unlinked_discord_id = None
 
-            existing_alt_uuid = db.alt_uid_exists(uid)
+            existing_alt_uuid = await adb.alt_uid_exists(uid)
             if existing_alt_uuid:
                 await interaction.edit_original_message(
                     embed=create_message_embed(
@@ -100,10 +138,16 @@ async def link(interaction: Interaction, ltuid: str, ltoken: str):
                 )
                 return
 
-            if db.uid_exists(uid):
-                unlinked_discord_id = db.delete_entry_by_uid(uid)
+            if await adb.uid_exists(uid):
+                unlinked_discord_id = await adb.delete_entry_by_uid(uid)
 
-            db.update_link_entry(discord_id, uid, ltuid, ltoken)
+            util.discard_clients(await adb.get_link_entry(discord_id))
+            await adb.update_link_entry(discord_id, uid, ltuid, ltoken)
+            await adb.flush()
+            await rewards.slot_in(
+                "daily_rewards", await adb.get_link_entry(discord_id), "genshin"
+            )
+            response_cache.invalidate(uid)
 
             embed = create_link_profile_embed(
                 discord_id, interaction.user.avatar.url, uid, level, username
@@ -177,12 +221,17 @@ async def link_hsr(
             discord_id = interaction.user.id
             unlinked_discord_id = None
 
-            if db.hsr_uid_exists(uid):
-                unlinked_discord_id = db.hsr_delete_entry_by_uid(uid)
+            if await adb.hsr_uid_exists(uid):
+                unlinked_discord_id = await adb.hsr_delete_entry_by_uid(uid)
 
-            db.update_hsr_link_entry(
+            util.discard_clients(await adb.get_hsr_link_entry(discord_id))
+            await adb.update_hsr_link_entry(
                 discord_id, uid, ltuid, ltoken, account_mid, cookie_token
             )
+            await adb.flush()
+            await rewards.slot_in(
+                "daily_hsr_rewards", await adb.get_hsr_link_entry(discord_id), "hsr"
+            )
 
             embed = create_link_profile_embed(
                 discord_id, interaction.user.avatar.url, uid, level, username, True
@@ -217,9 +266,8 @@ async def link_hsr(
 async def link_alt(interaction: Interaction, ltuid: str, ltoken: str, name: str):
 
     discord_id = interaction.user.id
-    settings = util.get_settings()
 
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -258,7 +306,7 @@ async def link_alt(interaction: Interaction, ltuid: str, ltoken: str, name: str)
             username = na_account.nickname
             discord_id = interaction.user.id
 
-            if db.uid_exists(uid):
+            if await adb.uid_exists(uid):
                 await interaction.edit_original_message(
                     embed=create_message_embed(
                         f"UID {uid} already exists as a linked main account."
@@ -266,12 +314,19 @@ async def link_alt(interaction: Interaction, ltuid: str, ltoken: str, name: str)
                 )
                 return
 
-            existing_alt_uuid = db.alt_uid_exists(uid)
+            existing_alt_uuid = await adb.alt_uid_exists(uid)
 
             if existing_alt_uuid:
-                db.delete_alt_entry(existing_alt_uuid)
-
-            db.create_alt_entry(name, uid, ltuid, ltoken)
+                util.discard_clients(await adb.get_alt_data(existing_alt_uuid))
+                await adb.delete_alt_entry(existing_alt_uuid)
+
+            await adb.create_alt_entry(name, uid, ltuid, ltoken)
+            await adb.flush()
+            await rewards.slot_in(
+                "daily_rewards",
+                await adb.get_alt_data(await adb.alt_uid_exists(uid)),
+                "genshin",
+            )
 
             embed = create_link_profile_embed(
                 discord_id, interaction.user.avatar.url, uid, level, username
@@ -301,9 +356,8 @@ async def link_alt(interaction: Interaction, ltuid: str, ltoken: str, name: str)
 @bot.slash_command(name="deletealt", description="Ganyu mod usage only.")
 async def delete_alt(interaction: Interaction, uuid: str):
     discord_id = interaction.user.id
-    settings = util.get_settings()
 
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -311,13 +365,13 @@ async def delete_alt(interaction: Interaction, uuid: str):
         )
         return
 
-    if not db.get_alt_data(uuid):
+    if not await adb.get_alt_data(uuid):
         await interaction.response.send_message(
             embed=create_message_embed("Alt with that UUID doesn't exist.")
         )
         return
 
-    db.delete_alt_entry(uuid)
+    await adb.delete_alt_entry(uuid)
     await interaction.response.send_message(
         embed=create_message_embed(f"Deleted alt with UUID {uuid}.")
     )
@@ -329,7 +383,7 @@ async def delete_alt(interaction: Interaction, uuid: str):
 )
 async def link_code(interaction: Interaction, account_id: str, cookie_token: str):
     discord_id = interaction.user.id
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if user_data:
         if not account_id.isnumeric():
             await interaction.response.send_message(
@@ -340,8 +394,12 @@ async def link_code(interaction: Interaction, account_id: str, cookie_token: str
             )
             return
 
-        user_client = get_client(user_data["ltuid"], user_data["ltoken"])
-        user_client.set_cookies(account_id=account_id, cookie_token=cookie_token)
+        user_client = get_client(
+            user_data["ltuid"],
+            user_data["ltoken"],
+            account_id=account_id,
+            cookie_token=cookie_token,
+        )
 
         # Using API takes time, keep interaction alive by sending a "loading" response
         await interaction.response.send_message(
@@ -350,8 +408,9 @@ async def link_code(interaction: Interaction, account_id: str, cookie_token: str
         try:
             await user_client.redeem_code("TestCode")
         except RedemptionInvalid:
-            db.set_account_id(discord_id, account_id)
-            db.set_cookie_token(discord_id, cookie_token)
+            await adb.set_account_id(discord_id, account_id)
+            await adb.set_cookie_token(discord_id, cookie_token)
+            await adb.flush()
             await interaction.edit_original_message(
                 embed=create_message_embed(
                     "Successfully added extra authentication cookies.\nYou can now redeem codes!"
@@ -383,7 +442,7 @@ async def profile(interaction: Interaction):
     discord_id = interaction.user.id
     discord_name = interaction.user.name
     avatar_url = interaction.user.avatar.url
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if user_data:
         need_code_setup = (
             user_data["account_id"] is None or user_data["cookie_token"] is None
@@ -397,7 +456,12 @@ async def profile(interaction: Interaction):
             discord_name, avatar_url, user_data["uid"], user_settings
         )
         view = ProfileChoices(
-            discord_id, discord_name, avatar_url, need_code_setup, interaction
+            discord_id,
+            discord_name,
+            avatar_url,
+            need_code_setup,
+            interaction,
+            user_data,
         )
         await interaction.response.send_message(embed=embed, view=view)
     else:
@@ -415,7 +479,7 @@ async def hsr_profile(interaction: Interaction):
     discord_id = interaction.user.id
     discord_name = interaction.user.name
     avatar_url = interaction.user.avatar.url
-    user_data = db.get_hsr_link_entry(discord_id)
+    user_data = await adb.get_hsr_link_entry(discord_id)
     if user_data:
         user_settings = {
             "HSR Auto Check-in": "No" if user_data["daily_reward"] == 0 else "Yes",
@@ -424,7 +488,13 @@ async def hsr_profile(interaction: Interaction):
             discord_name, avatar_url, user_data["uid"], user_settings
         )
         view = ProfileChoices(
-            discord_id, discord_name, avatar_url, True, interaction, is_hsr=True
+            discord_id,
+            discord_name,
+            avatar_url,
+            True,
+            interaction,
+            user_data,
+            is_hsr=True,
         )
         await interaction.response.send_message(embed=embed, view=view)
     else:
@@ -437,7 +507,7 @@ async def hsr_profile(interaction: Interaction):
 
 @bot.user_command(name="Get Profile")
 async def get_profile(interaction: Interaction, member: nextcord.Member):
-    target_data = db.get_link_entry(member.id)
+    target_data = await adb.get_link_entry(member.id)
     if not target_data:
         embed = create_message_embed(f"{member.name} does not have an account linked!")
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -454,7 +524,13 @@ async def get_profile(interaction: Interaction, member: nextcord.Member):
         member.name, member.avatar, target_data["uid"], user_settings
     )
     view = ProfileChoices(
-        member.id, member.name, member.avatar, need_code_setup, interaction, probe=True
+        member.id,
+        member.name,
+        member.avatar,
+        need_code_setup,
+        interaction,
+        target_data,
+        probe=True,
     )
     await interaction.response.send_message(embed=embed, view=view)
 
@@ -464,7 +540,7 @@ async def get_profile(interaction: Interaction, member: nextcord.Member):
 )
 async def claim(interaction: Interaction):
     discord_id = interaction.user.id
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if not user_data:
         await interaction.response.send_message(
             embed=create_message_embed(
@@ -473,16 +549,25 @@ async def claim(interaction: Interaction):
         )
         return
 
+    if await rewards.get_claim(user_data, "genshin"):
+        await interaction.response.send_message(
+            embed=create_message_embed(
+                "Daily reward was already claimed today!", GANYU_COLORS["dark"]
+            )
+        )
+        return
+
     user_client = get_client(user_data["ltuid"], user_data["ltoken"])
     # Using API takes time, keep interaction alive by sending a "loading" response
     await interaction.response.send_message(embed=util.loading_embed())
-    try:
-        reward = await user_client.claim_daily_reward()
-
+    reward = await rewards.claim_daily_reward(
+        user_data, "genshin", user_client, reward=True
+    )
+    if reward:
         await interaction.edit_original_message(
             embed=create_reward_embed(reward.name, reward.amount, reward.icon)
         )
-    except AlreadyClaimed:
+    else:
         await interaction.edit_original_message(
             embed=create_message_embed(
                 "Daily reward was already claimed today!", GANYU_COLORS["dark"]
@@ -495,7 +580,7 @@ async def claim(interaction: Interaction):
 )
 async def hsr_claim(interaction: Interaction):
     discord_id = interaction.user.id
-    user_data = db.get_hsr_link_entry(discord_id)
+    user_data = await adb.get_hsr_link_entry(discord_id)
     if not user_data:
         await interaction.response.send_message(
             embed=create_message_embed(
@@ -504,6 +589,14 @@ async def hsr_claim(interaction: Interaction):
         )
         return
 
+    if await rewards.get_claim(user_data, "hsr"):
+        await interaction.response.send_message(
+            embed=create_message_embed(
+                "Daily reward was already claimed today!", GANYU_COLORS["dark"]
+            )
+        )
+        return
+
     user_client = get_hsr_client(
         user_data["ltuid"],
         user_data["ltoken"],
@@ -512,12 +605,14 @@ async def hsr_claim(interaction: Interaction):
     )
     # Using API takes time, keep interaction alive by sending a "loading" response
     await interaction.response.send_message(embed=util.loading_embed())
-    try:
-        reward = await user_client.claim_daily_reward()
+    reward = await rewards.claim_daily_reward(
+        user_data, "hsr", user_client, reward=True
+    )
+    if reward:
         await interaction.edit_original_message(
             embed=create_reward_embed(reward.name, reward.amount, reward.icon)
         )
-    except AlreadyClaimed:
+    else:
         await interaction.edit_original_message(
             embed=create_message_embed(
                 "Daily reward was already claimed today!", GANYU_COLORS["dark"]
@@ -531,7 +626,7 @@ async def hsr_claim(interaction: Interaction):
 async def status(interaction: Interaction):
     discord_id = interaction.user.id
     avatar_url = interaction.user.avatar.url
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if not user_data:
         await interaction.response.send_message(
             embed=create_message_embed(
@@ -544,9 +639,15 @@ async def status(interaction: Interaction):
     # Using API takes time, keep interaction alive by sending a "loading" response
     await interaction.response.send_message(embed=util.loading_embed())
     try:
-        notes = await user_client.get_notes(int(user_data["uid"]))
+        notes, fetched_at = await response_cache.get(
+            "get_notes",
+            response_cache.NOTES_TTL,
+            user_data,
+            user_client.get_notes,
+            int(user_data["uid"]),
+        )
         await interaction.edit_original_message(
-            embed=create_status_embed(notes, avatar_url)
+            embed=create_status_embed(notes, avatar_url, fetched_at)
         )
     except DataNotPublic:
         embed = create_message_embed(
@@ -567,37 +668,29 @@ async def schedule(interaction: Interaction, detailed: bool = False):
     discord_id = interaction.user.id
     avatar_url = interaction.user.avatar.url
 
-    schedule_info = util.get_schedule_info()
-    pages = []
-    if not detailed:
-        pages.append(
-            util.create_schedule_embed(schedule_info, bot.user.avatar.url, False)
-        )
-        pages.append(
-            util.create_schedule_embed(schedule_info, bot.user.avatar.url, True)
+    schedule_pages = await util.get_schedule_pages(bot.user.avatar.url, detailed)
+    if not schedule_pages:
+        await interaction.response.send_message(
+            embed=create_message_embed(
+                "Couldn't load the event schedule, try again later.",
+                GANYU_COLORS["dark"],
+            )
         )
-    else:
-        current = []
-        future = []
-        cur_time = int(time.time())
-
-        for event in schedule_info:
-            if event["start"] <= cur_time <= event["end"]:
-                current.append(event)
-            elif event["start"] > cur_time:
-                future.append(event)
-
-        current.sort(key=lambda x: x["end"])
-        future.sort(key=lambda x: x["start"])
-
-        for event in current:
-            pages.append(util.create_event_embed(event))
+        return
 
-        for event in future:
-            pages.append(util.create_event_embed(event))
+    page_count, page_factory = schedule_pages
+    if not page_count:
+        await interaction.response.send_message(
+            embed=create_message_embed(
+                "There are no current or upcoming events.", GANYU_COLORS["dark"]
+            )
+        )
+        return
 
-    view = MessageBook(discord_id, avatar_url, pages, interaction)
-    await interaction.response.send_message(embed=pages[0], view=view)
+    view = LazyMessageBook(
+        discord_id, avatar_url, page_count, page_factory, interaction
+    )
+    await interaction.response.send_message(embed=await view.get_page(0), view=view)
 
 
 @bot.slash_command(
@@ -606,7 +699,7 @@ async def schedule(interaction: Interaction, detailed: bool = False):
 async def income(interaction: Interaction):
     discord_id = interaction.user.id
     avatar_url = interaction.user.avatar.url
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if not user_data:
         await interaction.response.send_message(
             embed=create_message_embed(
@@ -618,13 +711,24 @@ async def income(interaction: Interaction):
     # Using API takes time, keep interaction alive by sending a "loading" response
     await interaction.response.send_message(embed=util.loading_embed())
     try:
-        diary = await user_client.get_genshin_diary()
-        pages = [
-            util.create_report_overview_embed(diary, avatar_url),
-            util.create_report_breakdown_embed(diary, avatar_url),
+        diary, fetched_at = await response_cache.get(
+            "get_genshin_diary",
+            response_cache.DIARY_TTL,
+            user_data,
+            user_client.get_genshin_diary,
+        )
+        page_factories = [
+            util.create_report_overview_embed,
+            util.create_report_breakdown_embed,
         ]
-        view = MessageBook(discord_id, avatar_url, pages, interaction)
-        await interaction.edit_original_message(embed=pages[0], view=view)
+        view = LazyMessageBook(
+            discord_id,
+            avatar_url,
+            len(page_factories),
+            lambda i: page_factories[i](diary, avatar_url, fetched_at),
+            interaction,
+        )
+        await interaction.edit_original_message(embed=await view.get_page(0), view=view)
 
     except Exception:
         traceback.print_exc()
@@ -637,7 +741,7 @@ async def income(interaction: Interaction):
 @bot.slash_command(name="redeem", description="Attempts to redeem a code.")
 async def redeem(interaction: Interaction, code: str):
     discord_id = interaction.user.id
-    user_data = db.get_link_entry(discord_id)
+    user_data = await adb.get_link_entry(discord_id)
     if not user_data:
         await interaction.response.send_message(
             embed=create_message_embed(
@@ -660,9 +764,11 @@ async def redeem(interaction: Interaction, code: str):
         )
         return
 
-    user_client = get_client(user_data["ltuid"], user_data["ltoken"])
-    user_client.set_browser_cookies(
-        account_id=user_data["account_id"], cookie_token=user_data["cookie_token"]
+    user_client = get_client(
+        user_data["ltuid"],
+        user_data["ltoken"],
+        account_id=user_data["account_id"],
+        cookie_token=user_data["cookie_token"],
     )
 
     # Using API takes time, keep interaction alive by sending a "loading" response
@@ -735,8 +841,7 @@ async def announce_code(interaction: Interaction, code: str):
 @bot.slash_command(name="log", description="Ganyu mod usage only.")
 async def log(interaction: Interaction):
     discord_id = interaction.user.id
-    settings = util.get_settings()
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -752,6 +857,7 @@ async def log(interaction: Interaction):
         )
         return
 
+    settings = util.get_settings()
     settings["log_channel"] = interaction.channel_id
     util.set_settings(settings)
     await interaction.response.send_message(
@@ -765,8 +871,7 @@ async def log(interaction: Interaction):
 @bot.slash_command(name="sendlog", description="Ganyu mod usage only.")
 async def sendlog(interaction: Interaction, message: str):
     discord_id = interaction.user.id
-    settings = util.get_settings()
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -774,6 +879,7 @@ async def sendlog(interaction: Interaction, message: str):
         )
         return
 
+    settings = util.get_settings()
     log_channel_id = settings.get("log_channel")
     if log_channel_id:
         channel = bot.get_channel(log_channel_id)
@@ -798,9 +904,8 @@ async def sendlog(interaction: Interaction, message: str):
 @bot.slash_command(name="run", description="Ganyu mod usage only.")
 async def run_job(interaction: Interaction, job_id: str):
     discord_id = interaction.user.id
-    settings = util.get_settings()
 
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -827,9 +932,8 @@ async def run_job(interaction: Interaction, job_id: str):
 @bot.slash_command(name="ganyustatus", description="Ganyu mod usage only.")
 async def ganyu_status(interaction: Interaction):
     discord_id = interaction.user.id
-    settings = util.get_settings()
 
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -837,13 +941,36 @@ async def ganyu_status(interaction: Interaction):
         )
         return
 
-    user_count = db.user_count()
+    settings = util.get_settings()
+    user_count = await adb.user_count()
     bot_accounts = len(settings["accounts"])
     log_channel_id = settings.get("log_channel")
 
+    pool_stats = client_pool.pool.stats()
+    link_cache_stats = await adb.link_cache_stats()
+
     embed = nextcord.Embed(title=f"Ganyu Status")
     embed.add_field(name="Linked Users", value=user_count)
     embed.add_field(name="Bot Accounts", value=bot_accounts)
+    embed.add_field(
+        name="Client Pool",
+        value=f"{pool_stats['size']} client(s), {pool_stats['hit_ratio']:.0%} hit ratio\n"
+        f"{pool_stats['hits']} hit(s), {pool_stats['misses']} miss(es), "
+        f"{pool_stats['evictions']} eviction(s)",
+    )
+    embed.add_field(
+        name="Linked User Cache",
+        value=f"{link_cache_stats['size']} record(s), {link_cache_stats['hit_ratio']:.0%} hit ratio\n"
+        f"{link_cache_stats['hits']} hit(s), {link_cache_stats['misses']} miss(es)",
+    )
+    response_cache_stats = response_cache.stats()
+    embed.add_field(
+        name="Response Cache",
+        value=f"{response_cache_stats['size']} response(s), {response_cache_stats['hit_ratio']:.0%} hit ratio\n"
+        f"{response_cache_stats['hits']} hit(s), {response_cache_stats['misses']} miss(es)",
+    )
+    if len(slots.timers):
+        embed.add_field(name="Slotted Claims", value=f"{len(slots.timers)} waiting")
     if log_channel_id:
         embed.add_field(name="Log Channel", value=f"<#{log_channel_id}>", inline=False)
     jobs = util.get_scheduler_jobs(scheduler)
@@ -885,18 +1012,44 @@ async def ganyu_status(interaction: Interaction):
             value=f"<t:{int(next_activity_feed_timestamp)}:F>",
             inline=False,
         )
+    if enka_poller.last_pass:
+        last_pass = enka_poller.last_pass
+        embed.add_field(
+            name="Last Activity Feed Update",
+            value=f"<t:{last_pass['finished']}:R>, fetched {last_pass['fetched']}/{last_pass['users']}"
+            f" user(s) in {last_pass['duration']:.1f} second(s)",
+            inline=False,
+        )
 
     embed.colour = GANYU_COLORS["dark"]
     embed.set_thumbnail(url=bot.user.avatar.url)
     await interaction.response.send_message(embed=embed)
 
 
+@bot.slash_command(name="traces", description="Ganyu mod usage only.")
+async def traces(interaction: Interaction):
+    discord_id = interaction.user.id
+    if not util.is_mod(discord_id):
+        await interaction.response.send_message(
+            embed=create_message_embed(
+                "You can't use this command...", GANYU_COLORS["dark"]
+            )
+        )
+        return
+
+    await interaction.response.send_message(
+        embed=util.create_traces_embed(
+            tracing.slowest_traces(), tracing.slow_trace_ms, tracing.slow_job_trace_ms
+        ),
+        ephemeral=True,
+    )
+
+
 @bot.slash_command(name="listalts", description="Ganyu mod usage only.")
 async def list_alts(interaction: Interaction):
     discord_id = interaction.user.id
-    settings = util.get_settings()
 
-    if discord_id not in settings["ganyu_mods"]:
+    if not util.is_mod(discord_id):
         await interaction.response.send_message(
             embed=create_message_embed(
                 "You can't use this command...", GANYU_COLORS["dark"]
@@ -904,7 +1057,7 @@ async def list_alts(interaction: Interaction):
         )
         return
 
-    alt_accounts = db.get_all_alts()
+    alt_accounts = await adb.get_all_alts()
     description_lines = []
     for alt in alt_accounts:
         description_lines.append(f"{alt['id']} ({alt['name']}): **{alt['uid']}**")
@@ -917,15 +1070,56 @@ async def list_alts(interaction: Interaction):
     await interaction.response.send_message(embed=embed)
 
 
+async def collect_rewards(job, settings):
+    # In process, or split across claim_shards worker.py processes
+    result = await rewards.run(job, settings)
+    attempt = result["attempt"]
+    failed = len(attempt["failed"]["users"]) + len(attempt["failed"]["alts"])
+    metrics.JOB_ITEMS.inc(
+        attempt["claimed"] - attempt["skipped"], job=job, outcome="claimed"
+    )
+    metrics.JOB_ITEMS.inc(attempt["skipped"], job=job, outcome="skipped")
+    metrics.JOB_ITEMS.inc(failed - attempt["quarantined"], job=job, outcome="failed")
+    metrics.JOB_ITEMS.inc(attempt["quarantined"], job=job, outcome="quarantined")
+    return result
+
+
+def window_summary(settings):
+    # Sharded runs don't slot, see rewards.run
+    window = settings.get("claim_window", 0)
+    if window and settings.get("claim_shards", 1) <= 1:
+        return f", spread over {window // 60} minute(s)"
+    return ""
+
+
+def run_summary(result):
+    summary = ""
+    if result["skipped"]:
+        summary += f"\nAlready claimed today: {result['skipped']}"
+    if result["quarantine_total"]:
+        summary += (
+            f"\nQuarantined (invalid cookies): {result['quarantined']} new,"
+            f" {result['quarantine_total']} total, skipped until they relink"
+        )
+    if result["resumed"]:
+        summary += "\nResumed an interrupted run"
+    if "shards" in result:
+        summary += f"\nShards: {result['shards']}"
+        if result["missing_shards"]:
+            missing = ", ".join(str(shard + 1) for shard in result["missing_shards"])
+            summary += f" (shard(s) {missing} didn't finish, rerun to resume)"
+    return summary
+
+
 @scheduler.scheduled_job(util.DAILY_REWARD_CRON_TRIGGER, id="daily_rewards")
+@tracing.traced("job.daily_rewards")
 async def auto_collect_daily_rewards():
 
-    users = db.get_all_auto_checkin_users()
-    alt_users = db.get_all_alts()
+    users = await adb.get_all_auto_checkin_users()
+    alt_users = await adb.get_all_alts()
 
     settings = util.get_settings()
     log_channel_id = settings.get("log_channel")
-    success = 0
     start_time = int(time.time())
     if log_channel_id:
         channel = bot.get_channel(log_channel_id)
@@ -937,31 +1131,14 @@ async def auto_collect_daily_rewards():
             # return
             await channel.send(
                 embed=create_message_embed(
-                    f"Collecting daily rewards for **{len(users)}** user(s), **{len(alt_users)}** alt(s)..."
+                    f"Collecting daily rewards for **{len(users)}** user(s), **{len(alt_users)}** alt(s){window_summary(settings)}..."
                 )
             )
 
-    failed_users = []
-    for user_data in users:
-        user_client = get_client(user_data["ltuid"], user_data["ltoken"])
-        try:
-            await user_client.claim_daily_reward(reward=False)
-            success += 1
-        except GenshinException:
-            failed_users.append(user_data["discord_id"])
-
-        await asyncio.sleep(random.randint(0, 2))
-
-    failed_alt_users = []
-    for user_data in alt_users:
-        user_client = get_client(user_data["ltuid"], user_data["ltoken"])
-        try:
-            await user_client.claim_daily_reward(reward=False)
-            success += 1
-        except GenshinException:
-            failed_alt_users.append(user_data["name"])
-
-        await asyncio.sleep(random.randint(0, 2))
+    result = await collect_rewards("daily_rewards", settings)
+    success = result["claimed"]
+    failed_users = result["failed"]["users"]
+    failed_alt_users = result["failed"]["alts"]
 
     time_elapsed = int(time.time()) - start_time
     if log_channel_id:
@@ -969,15 +1146,15 @@ async def auto_collect_daily_rewards():
         if channel:
             await channel.send(
                 embed=create_message_embed(
-                    f"Successfully collected rewards for {success}/{len(users) + len(alt_users)} user(s)\n"
-                    f"Time elapsed: {time_elapsed} second(s)"
+                    f"Successfully collected rewards for {success}/{result['total']} user(s)\n"
+                    f"Time elapsed: {time_elapsed} second(s){run_summary(result)}"
                 )
             )
-            if failed_users:
-                fails = [f"<@{user_id}>" for user_id in failed_users]
-                for name in failed_alt_users:
-                    fails.append(f"**{name}**")
+            fails = [f"<@{user_id}>" for user_id in failed_users]
+            for name in failed_alt_users:
+                fails.append(f"**{name}**")
 
+            if fails:
                 failed_text = " ".join(fails[:20])
                 if len(fails) > 20:
                     failed_text += f" and {len(fails) - 20} more..."
@@ -1001,38 +1178,26 @@ async def auto_collect_daily_rewards():
 
 
 @scheduler.scheduled_job(util.DAILY_HSR_REWARD_CRON_TRIGGER, id="daily_hsr_rewards")
+@tracing.traced("job.daily_hsr_rewards")
 async def auto_collect_hsr_daily_rewards():
 
-    users = db.get_all_hsr_auto_checkin_users()
+    users = await adb.get_all_hsr_auto_checkin_users()
 
     settings = util.get_settings()
     log_channel_id = settings.get("log_channel")
-    success = 0
     start_time = int(time.time())
     if log_channel_id:
         channel = bot.get_channel(log_channel_id)
         if channel:
             await channel.send(
                 embed=create_message_embed(
-                    f"Collecting daily HSR rewards for **{len(users)}** user(s)..."
+                    f"Collecting daily HSR rewards for **{len(users)}** user(s){window_summary(settings)}..."
                 )
             )
 
-    failed_users = []
-    for user_data in users:
-        user_client = get_hsr_client(
-            user_data["ltuid"],
-            user_data["ltoken"],
-            user_data["account_mid"],
-            user_data["cookie_token"],
-        )
-        try:
-            await user_client.claim_daily_reward(reward=False)
-            success += 1
-        except GenshinException:
-            failed_users.append(user_data["discord_id"])
-
-        await asyncio.sleep(random.randint(0, 2))
+    result = await collect_rewards("daily_hsr_rewards", settings)
+    success = result["claimed"]
+    failed_users = result["failed"]["users"]
 
     time_elapsed = int(time.time()) - start_time
     if log_channel_id:
@@ -1040,8 +1205,8 @@ async def auto_collect_hsr_daily_rewards():
         if channel:
             await channel.send(
                 embed=create_message_embed(
-                    f"Successfully collected HSR rewards for {success}/{len(users)} user(s)\n"
-                    f"Time elapsed: {time_elapsed} second(s)"
+                    f"Successfully collected HSR rewards for {success}/{result['total']} user(s)\n"
+                    f"Time elapsed: {time_elapsed} second(s){run_summary(result)}"
                 )
             )
             if failed_users:
@@ -1071,14 +1236,11 @@ async def auto_collect_hsr_daily_rewards():
 
 # @scheduler.scheduled_job(util.CODE_POLLER_CRON_TRIGGER, id="code_poller")
 async def poll_for_reddit_codes():
-    headers = {"User-Agent": "GanyuBot 3.0"}
-
     QUERY_URL = (
         "https://old.reddit.com/r/Genshin_Impact/search.json?q=code&restrict_sr=1&t=day"
     )
     TEST_URL = "https://old.reddit.com/r/Genshin_Impact/search.json?q=code&restrict_sr=1&t=week"
-    res = requests.get(QUERY_URL, headers=headers)
-    search_data = res.json()
+    search_data = await net.get_json(QUERY_URL)
 
     code_regex = re.compile(r" *[A-Z0-9]{12} *")
     code_link_regex = re.compile(
@@ -1105,8 +1267,7 @@ async def poll_for_reddit_codes():
             comment_codes = []
             # search comments
             post_url = f"https://www.reddit.com{post['data']['permalink'][:-1]}.json"
-            post_res = requests.get(post_url, headers=headers)
-            post_data = post_res.json()
+            post_data = await net.get_json(post_url)
             if len(post_data) > 1:
                 comments = post_data[1]
                 for comment in comments["data"]["children"]:
@@ -1142,9 +1303,10 @@ async def poll_for_reddit_codes():
 
 
 @scheduler.scheduled_job(util.ACTIVITY_FEED_CRON_TRIGGER, id="activity_feed_update")
+@tracing.traced("job.activity_feed_update")
 async def poll_enka():
 
-    users = db.get_all_tracked_users()
+    users = await adb.get_all_tracked_users()
 
     settings = util.get_settings()
     log_channel_id = settings.get("log_channel")
@@ -1152,64 +1314,114 @@ async def poll_enka():
     if log_channel_id:
         channel = bot.get_channel(log_channel_id)
 
-    for user in users:
-
-        uid = user["uid"]
-        last_activity = db.get_latest_activity(user["discord_id"])
-
-        headers = {"User-Agent": "GanyuBot 3.0"}
-
-        try:
-            res = requests.get(
-                f"https://enka.network/api/uid/{uid}?info", headers=headers
+    latest_activities = await adb.get_latest_tracked_activities()
+
+    async def process(user, enka_data):
+        last_activity = latest_activities.get(user["discord_id"])
+        player_info = enka_data["playerInfo"]
+        changed = (
+            last_activity
+            and channel
+            and (
+                last_activity["level"] != player_info["level"]
+                or last_activity["world_level"] != player_info["worldLevel"]
+                or last_activity["finish_achievement_num"]
+                != player_info["finishAchievementNum"]
+                or last_activity["tower_floor_index"] != player_info["towerFloorIndex"]
+                or last_activity["tower_level_index"] != player_info["towerLevelIndex"]
             )
-            enka_data = res.json()
-            db.log_activity(user["discord_id"], enka_data)
-            if last_activity and channel:
-                player_info = enka_data["playerInfo"]
-                if (
-                    last_activity["level"] != player_info["level"]
-                    or last_activity["world_level"] != player_info["worldLevel"]
-                    or last_activity["finish_achievement_num"]
-                    != player_info["finishAchievementNum"]
-                    or last_activity["tower_floor_index"]
-                    != player_info["towerFloorIndex"]
-                    or last_activity["tower_level_index"]
-                    != player_info["towerLevelIndex"]
-                ):
-                    embed = create_activity_update_embed(
-                        user["discord_id"], uid, last_activity, player_info
-                    )
-                    await channel.send(embed=embed)
-        except Exception:
-            import traceback
-
-            logging.info(f"Error while fetching enka data for uid {uid}; skipping")
-            traceback.print_exc()
+        )
+        # read before log_activity bumps it, the change happened since then
+        last_seen = await adb.get_last_seen(user["discord_id"]) if changed else None
+        await adb.log_activity(user["discord_id"], enka_data, latest_activities)
+        if changed:
+            embed = create_activity_update_embed(
+                user["discord_id"], user["uid"], last_activity, player_info, last_seen
+            )
+            await channel.send(embed=embed)
 
-        # sleep to not spam enka api and get rate limited
-        await asyncio.sleep(2)
+    last_pass = await enka_poller.run(users, process)
+    for outcome in ("fetched", "skipped", "errors"):
+        metrics.JOB_ITEMS.inc(
+            last_pass[outcome], job="activity_feed_update", outcome=outcome
+        )
 
 
 @scheduler.scheduled_job(util.ACTIVITY_FEED_CLEANUP_TRIGGER, id="activity_feed_cleanup")
+@tracing.traced("job.activity_feed_cleanup")
 async def cleanup_activities():
-    db.purge_activities()
+    await adb.purge_activities()
+    await adb.purge_reward_runs()
 
 
 @bot.event
 async def on_ready():
+    global started
     print("Logged into Discord!")
-    init()
+    # on_ready fires again after every reconnect, set up only once
+    if started:
+        return
+    started = True
+    await init()
     scheduler.start()
+    await start_metrics(util.get_settings())
+    if util.get_settings().get("claim_window"):
+        scheduler.reschedule_job(
+            "daily_rewards", trigger=util.DAILY_REWARD_SLOT_TRIGGER
+        )
+        scheduler.reschedule_job(
+            "daily_hsr_rewards", trigger=util.DAILY_HSR_REWARD_SLOT_TRIGGER
+        )
+    now = datetime.datetime.now(tz=pytz.UTC)
+    # warm the timeline right away instead of waiting for the first interval
+    scheduler.get_job("timeline_refresh").modify(next_run_time=now)
+    # a restart in the middle of a collection leaves today's run open, resume it
+    for reward_run in await adb.get_open_reward_runs(rewards.reward_day()):
+        logging.info(f"Resuming interrupted {reward_run['job']} run")
+        scheduler.get_job(reward_run["job"]).modify(next_run_time=now)
     logging.info(util.get_scheduler_jobs(scheduler))
     await bot.discover_application_commands()
     await bot.sync_all_application_commands()
 
 
-def init():
+@scheduler.scheduled_job(util.TIMELINE_REFRESH_TRIGGER, id="timeline_refresh")
+@tracing.traced("job.timeline_refresh")
+async def refresh_timeline():
+    await util.refresh_schedule_info()
+
+
+async def flush_db():
+    await adb.flush()
+
+
+async def init():
     global cache
     cache = Cache("cache")
-    db.init()
+    settings = util.get_settings()
+    await adb.init(write_behind=settings.get("db_write_behind", False))
+    # nothing to flush unless writes are batched
+    if settings.get("db_write_behind", False):
+        scheduler.add_job(flush_db, util.DB_FLUSH_TRIGGER, id="db_flush")
+    enka_poller.configure(settings)
+    util.settings_store.subscribe(enka_poller.configure)
+    tracing.configure(settings)
+    util.settings_store.subscribe(tracing.configure)
+    # bot.run stops the loop on SIGTERM (docker stop) and returns normally,
+    # so pending writes are flushed here
+    atexit.register(db.close)
+
+
+async def start_metrics(settings):
+    metrics_port = settings.get("metrics_port", metrics.DEFAULT_METRICS_PORT)
+    if not metrics_port:
+        return
+    # the bot runs fine without its metrics, e.g. when the port is taken
+    try:
+        await metrics.start_server(
+            settings.get("metrics_host", metrics.DEFAULT_METRICS_HOST), metrics_port
+        )
+    except OSError as e:
+        logging.warning(f"Couldn't start the metrics server, running without it: {e}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+
+import aiohttp
+from aiohttp import web
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9150
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# Outgoing request host suffix -> upstream label
+UPSTREAMS = {
+    "hoyolab.com": "hoyolab",
+    "hoyoverse.com": "hoyolab",
+    "mihoyo.com": "hoyolab",
+    "enka.network": "enka",
+    "paimon.moe": "paimon.moe",
+    "reddit.com": "reddit",
+}
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        # label values tuple -> value (or per metric state)
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def labels_for(self, key, **extra):
+        return list(zip(self.label_names, key)) + list(extra.items())
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for key, value in sorted(self.values.items()):
+            lines.extend(self.render_value(key, value))
+        return lines
+
+    def render_value(self, key, value):
+        return [
+            f"{self.name}{format_labels(self.labels_for(key))} {format_value(value)}"
+        ]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # [per bucket counts (last one is +Inf), sum]
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = format_labels(self.labels_for(key, le=format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels_for(key))
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        # functions run before every scrape, e.g. to copy cache stats into gauges
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception:
+                logging.exception("Metrics collector failed")
+
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+COMMAND_DURATION = registry.register(
+    Histogram(
+        "ganyu_command_duration_seconds",
+        "Slash command handling time.",
+        ["command"],
+    )
+)
+COMMAND_ERRORS = registry.register(
+    Counter(
+        "ganyu_command_errors_total",
+        "Slash commands that raised an error.",
+        ["command"],
+    )
+)
+UPSTREAM_DURATION = registry.register(
+    Histogram(
+        "ganyu_upstream_request_duration_seconds",
+        "Outgoing HTTP request time per upstream.",
+        ["upstream"],
+    )
+)
+UPSTREAM_ERRORS = registry.register(
+    Counter(
+        "ganyu_upstream_errors_total",
+        "Outgoing HTTP requests that failed or returned an error status.",
+        ["upstream"],
+    )
+)
+JOB_DURATION = registry.register(
+    Histogram(
+        "ganyu_job_duration_seconds",
+        "Scheduled job run time.",
+        ["job"],
+        buckets=JOB_BUCKETS,
+    )
+)
+JOB_ERRORS = registry.register(
+    Counter("ganyu_job_errors_total", "Scheduled job runs that raised.", ["job"])
+)
+JOB_ITEMS = registry.register(
+    Counter(
+        "ganyu_job_items_total",
+        "Users processed by scheduled jobs, by outcome.",
+        ["job", "outcome"],
+    )
+)
+DB_DURATION = registry.register(
+    Histogram(
+        "ganyu_db_query_duration_seconds",
+        "Database call time, including time queued for the db thread.",
+        ["query"],
+        buckets=DB_BUCKETS,
+    )
+)
+CACHE_HITS = registry.register(
+    Gauge("ganyu_cache_hits", "Cache hits since startup.", ["cache"])
+)
+CACHE_MISSES = registry.register(
+    Gauge("ganyu_cache_misses", "Cache misses since startup.", ["cache"])
+)
+CACHE_SIZE = registry.register(
+    Gauge("ganyu_cache_size", "Entries currently cached.", ["cache"])
+)
+
+
+def register_cache(name, stats):
+    # stats returns a dict with at least size, hits and misses
+    def collect():
+        cache_stats = stats()
+        CACHE_HITS.set(cache_stats["hits"], cache=name)
+        CACHE_MISSES.set(cache_stats["misses"], cache=name)
+        CACHE_SIZE.set(cache_stats["size"], cache=name)
+
+    registry.add_collector(collect)
+
+
+def upstream_for(host):
+    host = host or ""
+    for suffix, upstream in UPSTREAMS.items():
+        if host == suffix or host.endswith("." + suffix):
+            return upstream
+    return "other"
+
+
+async def on_request_start(session, context, params):
+    context.start_time = time.perf_counter()
+
+
+async def on_request_end(session, context, params):
+    upstream = upstream_for(params.url.host)
+    UPSTREAM_DURATION.observe(
+        time.perf_counter() - context.start_time, upstream=upstream
+    )
+    if params.response.status >= 400:
+        UPSTREAM_ERRORS.inc(upstream=upstream)
+
+
+async def on_request_exception(session, context, params):
+    upstream = upstream_for(params.url.host)
+    UPSTREAM_DURATION.observe(
+        time.perf_counter() - context.start_time, upstream=upstream
+    )
+    UPSTREAM_ERRORS.inc(upstream=upstream)
+
+
+def trace_config():
+    # Attached to every outgoing session so all upstream calls are timed,
+    # including the ones genshin.py makes on our behalf
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
+
+
+# Scheduler job id -> start time of the run in progress
+job_starts = {}
+
+
+def on_job_submitted(event):
+    job_starts[event.job_id] = time.perf_counter()
+
+
+def on_job_finished(event):
+    start_time = job_starts.pop(event.job_id, None)
+    if start_time is not None:
+        JOB_DURATION.observe(time.perf_counter() - start_time, job=event.job_id)
+    if event.exception:
+        JOB_ERRORS.inc(job=event.job_id)
+
+
+async def handle_metrics(request):
+    return web.Response(
+        text=registry.render(), content_type="text/plain", charset="utf-8"
+    )
+
+
+runner = None
+
+
+async def start_server(host=DEFAULT_METRICS_HOST, port=DEFAULT_METRICS_PORT):
+    global runner
+    if runner is not None:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app_runner = web.AppRunner(app, access_log=None)
+    await app_runner.setup()
+    try:
+        await web.TCPSite(app_runner, host, port).start()
+    except OSError:
+        await app_runner.cleanup()
+        raise
+    runner = app_runner
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
@@ -0,0 +1,63 @@
+import aiohttp
+
+import metrics
+import tracing
+
+DEFAULT_HEADERS = {"User-Agent": "GanyuBot 3.0"}
+MAX_CONNECTIONS = 100
+MAX_CONNECTIONS_PER_HOST = 20
+REQUEST_TIMEOUT = 30
+
+connector = None
+session = None
+
+
+def trace_configs():
+    return [metrics.trace_config(), tracing.trace_config()]
+
+
+def get_connector():
+    # Shared by every outgoing request (enka, paimon.moe, reddit and the pooled
+    # genshin clients) so keep-alive connections are reused across all of them
+    global connector
+    if connector is None or connector.closed:
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS,
+            limit_per_host=MAX_CONNECTIONS_PER_HOST,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+    return connector
+
+
+def get_session():
+    global session
+    if session is None or session.closed or session.connector.closed:
+        session = aiohttp.ClientSession(
+            connector=get_connector(),
+            connector_owner=False,
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            trace_configs=trace_configs(),
+        )
+    return session
+
+
+async def get_text(url, **kwargs):
+    async with get_session().get(url, **kwargs) as res:
+        return await res.text()
+
+
+async def get_json(url, **kwargs):
+    async with get_session().get(url, **kwargs) as res:
+        return await res.json(content_type=None)
+
+
+async def close():
+    global connector, session
+    if session is not None:
+        await session.close()
+        session = None
+    if connector is not None:
+        await connector.close()
+        connector = None
@@ -0,0 +1,52 @@
+import time
+
+from cachetools import LRUCache
+
+import singleflight
+
+NOTES_TTL = 60  # 1 min
+DIARY_TTL = 600  # 10 min
+RESPONSE_CACHE_SIZE = 4096
+
+# (endpoint, ltuid, uid) -> (ltoken, fetched at, result)
+responses = LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+hits = 0
+misses = 0
+
+
+async def get(endpoint, ttl, user_data, func, *args):
+    # Returns (result, fetched at) for an upstream call made on behalf of a
+    # linked account, reusing a result younger than ttl fetched with the same
+    # cookies. Misses for the same key share one upstream call.
+    global hits, misses
+    key = (endpoint, user_data["ltuid"], user_data["uid"])
+    entry = responses.get(key)
+    if entry and entry[0] == user_data["ltoken"] and time.time() - entry[1] < ttl:
+        hits += 1
+        return entry[2], entry[1]
+
+    misses += 1
+    result, fetched_at = await singleflight.do(key, fetch, func, *args)
+    responses[key] = (user_data["ltoken"], fetched_at, result)
+    return result, fetched_at
+
+
+async def fetch(func, *args):
+    result = await func(*args)
+    return result, int(time.time())
+
+
+def invalidate(uid):
+    # Called when an account is relinked so the next view reflects the new link
+    for key in [key for key in responses if key[2] == uid]:
+        responses.pop(key, None)
+
+
+def stats():
+    lookups = hits + misses
+    return {
+        "size": len(responses),
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / lookups if lookups else 0,
+    }
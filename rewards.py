@@ -0,0 +1,403 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import sys
+import time
+import zlib
+from datetime import datetime
+
+from genshin.errors import AlreadyClaimed, InvalidCookies
+
+import adb
+import slots
+import timeline
+import util
+from claim_engine import ClaimEngine
+
+WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+PROGRESS_INTERVAL = 10  # seconds between shard progress reports
+
+
+def shard_for(key, shards):
+    # crc32 rather than hash() so every process agrees on the partition
+    return zlib.crc32(str(key).encode()) % shards
+
+
+def reward_day():
+    # HoYoLAB daily rewards reset at midnight UTC+8
+    return datetime.now(timeline.ASIA_TZ).date().isoformat()
+
+
+def account_key(item):
+    if "discord_id" in item:
+        return f"user:{item['discord_id']}"
+    return f"alt:{item['id']}"
+
+
+def account_label(item):
+    return str(item["discord_id"]) if "discord_id" in item else item["name"]
+
+
+def ledger_account(user_data):
+    # The ledger is per HoYoLAB account, users and alts can share one
+    return str(user_data["ltuid"])
+
+
+def quarantine_key(user_data):
+    # Quarantine goes by cookies, an item still holding the old ones can't
+    # quarantine the account again once it's relinked with new ones
+    token_hash = hashlib.sha256(user_data["ltoken"].encode()).hexdigest()[:16]
+    return f"{ledger_account(user_data)}:{token_hash}"
+
+
+async def get_claim(user_data, game):
+    return await adb.get_claim(ledger_account(user_data), game, reward_day())
+
+
+async def claim_daily_reward(user_data, game, user_client, reward=False):
+    # Claims and records the outcome in today's ledger. Returns the reward if
+    # asked for, None when HoYoLAB says it was already claimed.
+    try:
+        result = await user_client.claim_daily_reward(reward=reward)
+    except AlreadyClaimed:
+        await adb.record_claim(
+            ledger_account(user_data), game, reward_day(), "already_claimed"
+        )
+        return None
+    await adb.record_claim(ledger_account(user_data), game, reward_day(), "claimed")
+    return result
+
+
+async def claim_genshin(user_data):
+    user_client = util.get_client(user_data["ltuid"], user_data["ltoken"])
+    await claim_daily_reward(user_data, "genshin", user_client)
+
+
+async def claim_hsr(user_data):
+    user_client = util.get_hsr_client(
+        user_data["ltuid"],
+        user_data["ltoken"],
+        user_data["account_mid"],
+        user_data["cookie_token"],
+    )
+    await claim_daily_reward(user_data, "hsr", user_client)
+
+
+CLAIMS = {"genshin": claim_genshin, "hsr": claim_hsr}
+
+
+async def daily_reward_batches(shard=0, shards=1):
+    # Sharded by HoYoLAB account so accounts sharing cookies land in the same
+    # shard. Quarantined accounts are left out until they relink
+    quarantined = await adb.get_quarantined_accounts("genshin")
+    users = [
+        user_data
+        for user_data in await adb.get_all_auto_checkin_users()
+        if shard_for(ledger_account(user_data), shards) == shard
+        and quarantine_key(user_data) not in quarantined
+    ]
+    alts = [
+        alt_data
+        for alt_data in await adb.get_all_alts()
+        if shard_for(ledger_account(alt_data), shards) == shard
+        and quarantine_key(alt_data) not in quarantined
+    ]
+    return [(users, "genshin"), (alts, "genshin")]
+
+
+async def hsr_daily_reward_batches(shard=0, shards=1):
+    quarantined = await adb.get_quarantined_accounts("hsr")
+    users = [
+        user_data
+        for user_data in await adb.get_all_hsr_auto_checkin_users()
+        if shard_for(ledger_account(user_data), shards) == shard
+        and quarantine_key(user_data) not in quarantined
+    ]
+    return [(users, "hsr")]
+
+
+# job -> function returning the (accounts, game) batches for a shard
+JOBS = {
+    "daily_rewards": daily_reward_batches,
+    "daily_hsr_rewards": hsr_daily_reward_batches,
+}
+
+
+def empty_result(total=0):
+    return {
+        "total": total,
+        "claimed": 0,
+        "skipped": 0,
+        "quarantined": 0,
+        "failed": {"users": [], "alts": []},
+    }
+
+
+class Collection:
+    # What one attempt at a run did, in the empty_result shape. Every outcome
+    # is checkpointed as it comes in, so an interrupted run picks up where it
+    # stopped, and accounts failing with invalid cookies are quarantined.
+    def __init__(self, run_id, report=None):
+        self.run_id = run_id
+        self.report = report
+        self.result = empty_result()
+        self.last_report = time.monotonic()
+        # (ledger account, game) pairs this attempt is claiming, a user and
+        # an alt sharing cookies are only claimed once
+        self.claiming = set()
+
+    async def pending(self, batches):
+        # Drops the accounts run_id already checkpointed, checkpoints the ones
+        # the ledger has as claimed today, or that share cookies with one
+        # already being claimed, as skipped (no request) and returns the rest
+        # as (items, game) batches
+        checkpoints = await adb.get_reward_checkpoints(self.run_id)
+        done = {row["account"] for row in checkpoints}
+        pending = []
+        for items, game in batches:
+            claimed = await adb.get_claimed_accounts(game, reward_day())
+            todo = []
+            for item in items:
+                if account_key(item) in done:
+                    continue
+                self.result["total"] += 1
+                ledger_key = (ledger_account(item), game)
+                if ledger_key[0] in claimed or ledger_key in self.claiming:
+                    await self.on_result(game, item, None, "skipped")
+                else:
+                    self.claiming.add(ledger_key)
+                    todo.append(item)
+            pending.append((todo, game))
+        return pending
+
+    async def on_result(self, game, item, error, outcome="claimed"):
+        # Awaits report(result) every PROGRESS_INTERVAL seconds if given
+        result = self.result
+        if isinstance(error, InvalidCookies):
+            outcome = "quarantined"
+            await adb.quarantine_account(quarantine_key(item), game, str(error))
+            result["quarantined"] += 1
+        elif error is not None:
+            outcome = "failed"
+        await adb.save_reward_checkpoint(
+            self.run_id, account_key(item), outcome, account_label(item)
+        )
+        if outcome == "skipped":
+            result["claimed"] += 1
+            result["skipped"] += 1
+        elif error is None:
+            result["claimed"] += 1
+        elif "discord_id" in item:
+            result["failed"]["users"].append(item["discord_id"])
+        else:
+            result["failed"]["alts"].append(item["name"])
+
+        if self.report and time.monotonic() - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = time.monotonic()
+            await self.report(result)
+
+
+async def collect(settings, run_id, batches, report=None, shards=1):
+    # Claims every account in batches that run_id hasn't done yet, as fast as
+    # the claim engine allows (its share when one of shards). Returns the
+    # attempt's Collection result.
+    collection = Collection(run_id, report)
+    engine = ClaimEngine.from_settings(settings, shards)
+    for items, game in await collection.pending(batches):
+        await engine.run(
+            items, CLAIMS[game], functools.partial(collection.on_result, game)
+        )
+    return collection.result
+
+
+# job -> slot_in(item, game) of its slotted run, while one is going
+slotted_runs = {}
+
+
+async def collect_slotted(settings, job, run_id, batches, window_start, window):
+    # Like collect(), but every account is claimed at its own slot in the
+    # window seconds from window_start instead of all at once, so HoYoLAB sees
+    # a flat rate. Slots come from the account key and stay put across days
+    # and restarts. Accounts linked while the run is going are slotted in
+    # through slot_in().
+    collection = Collection(run_id)
+    engine = ClaimEngine.from_settings(settings)
+    workers = asyncio.Semaphore(engine.workers)
+    # account key -> latest item, a relink before the slot swaps the cookies
+    scheduled = {}
+    finished = asyncio.Event()
+    # bookkeeping errors, the run fails (and stays open) once the rest is done
+    errors = []
+
+    async def claim(key, game, attempt=0):
+        item = scheduled[key]
+        async with workers:
+            error = await engine.attempt(item, CLAIMS[game])
+        if engine.should_retry(error, attempt):
+            slots.timers.schedule(
+                time.time() + engine.backoff(attempt),
+                functools.partial(claim, key, game, attempt + 1),
+            )
+            return
+        try:
+            await collection.on_result(game, item, error)
+        except Exception as e:
+            errors.append(e)
+            raise
+        finally:
+            del scheduled[key]
+            if not scheduled:
+                finished.set()
+
+    def add(item, game):
+        key = account_key(item)
+        if key not in scheduled:
+            due = window_start + slots.slot_offset(key, window)
+            slots.timers.schedule(due, functools.partial(claim, key, game))
+        scheduled[key] = item
+
+    async def slot_in(item, game):
+        if account_key(item) in scheduled:
+            scheduled[account_key(item)] = item
+            return
+        for items, game in await collection.pending([([item], game)]):
+            for item in items:
+                if not finished.is_set():
+                    add(item, game)
+
+    for items, game in await collection.pending(batches):
+        for item in items:
+            add(item, game)
+
+    if scheduled:
+        slotted_runs[job] = slot_in
+        try:
+            await finished.wait()
+        finally:
+            slotted_runs.pop(job, None)
+    if errors:
+        raise errors[0]
+    return collection.result
+
+
+async def slot_in(job, item, game):
+    # Gives a newly linked account a slot in job's run if one is going
+    if item and job in slotted_runs:
+        await slotted_runs[job](item, game)
+
+
+async def summarize(run_id, accounts):
+    # The outcome of the whole run, across every attempt and shard. Accounts
+    # quarantined by an earlier attempt aren't in the batches anymore but
+    # still count towards the total.
+    checkpoints = await adb.get_reward_checkpoints(run_id)
+    result = empty_result(
+        len(set(accounts) | {checkpoint["account"] for checkpoint in checkpoints})
+    )
+    for checkpoint in checkpoints:
+        outcome = checkpoint["outcome"]
+        if outcome in ("claimed", "skipped"):
+            result["claimed"] += 1
+        elif checkpoint["account"].startswith("user:"):
+            result["failed"]["users"].append(int(checkpoint["label"]))
+        else:
+            result["failed"]["alts"].append(checkpoint["label"])
+        if outcome in ("skipped", "quarantined"):
+            result[outcome] += 1
+    return result
+
+
+async def run(job, settings, shards=None):
+    # Runs job for today's reward day, resuming today's unfinished run if there
+    # is one. Returns the summarize() result plus run_id, resumed, this
+    # attempt's own result, quarantine_total and, when sharded, shards and
+    # missing_shards.
+    shards = shards or settings.get("claim_shards", 1)
+    window = settings.get("claim_window", 0)
+    open_runs = await adb.get_open_reward_runs(reward_day(), job)
+    if open_runs:
+        run_id = open_runs[0]["run_id"]
+        started = open_runs[0]["started"]
+        logging.info(f"Resuming {job} run {run_id}")
+    else:
+        run_id = await adb.create_reward_run(job, reward_day())
+        started = int(time.time())
+
+    batches = await JOBS[job]()
+    if shards > 1:
+        attempt, missing_shards = await run_sharded(job, shards, run_id)
+    elif window:
+        attempt = await collect_slotted(settings, job, run_id, batches, started, window)
+        missing_shards = []
+    else:
+        attempt = await collect(settings, run_id, batches)
+        missing_shards = []
+
+    if not missing_shards:
+        await adb.finish_reward_run(run_id)
+
+    result = await summarize(
+        run_id, [account_key(item) for items, _ in batches for item in items]
+    )
+    quarantined = set()
+    for _, game in batches:
+        quarantined |= await adb.get_quarantined_accounts(game)
+    result.update(
+        run_id=run_id,
+        resumed=bool(open_runs),
+        attempt=attempt,
+        quarantine_total=len(quarantined),
+    )
+    if shards > 1:
+        result.update(shards=shards, missing_shards=missing_shards)
+    return result
+
+
+async def run_sharded(job, shards, run_id):
+    # Runs job as one worker.py process per shard, returns the merged shard
+    # reports and the shards that didn't finish
+    # A write-behind transaction would hold the write lock for longer than
+    # the workers wait for it, commit every write right away meanwhile
+    await adb.suspend_write_behind()
+    try:
+        return await wait_for_shards(job, shards, run_id)
+    finally:
+        await adb.resume_write_behind()
+
+
+async def wait_for_shards(job, shards, run_id):
+    processes = [
+        await asyncio.create_subprocess_exec(
+            sys.executable,
+            WORKER_PATH,
+            job,
+            "--shard",
+            str(shard),
+            "--shards",
+            str(shards),
+            "--run-id",
+            run_id,
+        )
+        for shard in range(shards)
+    ]
+    await asyncio.gather(*[process.wait() for process in processes])
+
+    result = empty_result()
+    finished = set()
+    for report in await adb.get_shard_reports(run_id):
+        result["total"] += report["total"]
+        result["claimed"] += report["claimed"]
+        result["skipped"] += report["skipped"]
+        result["quarantined"] += report["quarantined"]
+        result["failed"]["users"] += report["failed"]["users"]
+        result["failed"]["alts"] += report["failed"]["alts"]
+        if report["finished"]:
+            finished.add(report["shard"])
+
+    missing_shards = [shard for shard in range(shards) if shard not in finished]
+    if missing_shards:
+        logging.warning(f"{job} shard(s) {missing_shards} didn't finish")
+
+    return result, missing_shards
@@ -0,0 +1,27 @@
+import asyncio
+
+# key -> future of the call currently running for that key
+in_flight = {}
+
+
+def start(key, func, *args, **kwargs):
+    # Returns the in-flight future for key, starting func(*args, **kwargs) if
+    # nothing identical is running yet
+    future = in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(func(*args, **kwargs))
+        in_flight[key] = future
+
+        def forget(done):
+            if in_flight.get(key) is done:
+                del in_flight[key]
+
+        future.add_done_callback(forget)
+
+    return future
+
+
+async def do(key, func, *args, **kwargs):
+    # Concurrent callers with the same key share one call and its result or
+    # exception; shielded so one caller being cancelled doesn't cancel the rest
+    return await asyncio.shield(start(key, func, *args, **kwargs))
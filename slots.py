@@ -0,0 +1,64 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import zlib
+
+
+def slot_offset(key, window):
+    # Seconds into the window for key, the same every day and in every process
+    return zlib.crc32(str(key).encode()) % max(1, int(window))
+
+
+class SlotScheduler:
+    # One timer heap for every slotted claim, whichever run it belongs to. A
+    # single task sleeps until the earliest entry is due and starts it, so a
+    # window of 100k accounts costs one timer instead of 100k.
+    def __init__(self):
+        # (due, seq, callback), due in unix time, seq keeps callbacks from
+        # being compared
+        self.heap = []
+        self.seq = itertools.count()
+        # created with the task, in the loop it runs in (asyncio.run in
+        # worker.py starts a new one, and 3.9 binds an Event to its loop)
+        self.wakeup = None
+        self.task = None
+        self.running = set()
+
+    def schedule(self, due, callback):
+        # Awaits callback() at due (unix time), or right away if due has passed
+        heapq.heappush(self.heap, (due, next(self.seq), callback))
+        if not self.task or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.loop())
+        else:
+            self.wakeup.set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    async def loop(self):
+        while self.heap:
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                # woken early when something earlier is scheduled
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, callback = heapq.heappop(self.heap)
+            task = asyncio.create_task(callback())
+            self.running.add(task)
+            task.add_done_callback(self.done)
+
+    def done(self, task):
+        self.running.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error("Slotted claim failed", exc_info=task.exception())
+
+
+timers = SlotScheduler()
@@ -0,0 +1,149 @@
+import json
+import re
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+
+# paimon.moe dates are either Asia server time (timezoneDependent) or GMT-5
+ASIA_TZ = timezone(timedelta(hours=8))
+GMT_MINUS_5_TZ = timezone(timedelta(hours=-5))
+
+# Covers the object literal subset the minified timeline chunk uses: strings
+# in any quote style, !0/!1 booleans, void 0, numbers and bare keys
+TOKEN_REGEX = re.compile(
+    r"""
+    (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\$]|\\.|\$(?!\{))*`)
+    | (?P<bool>![01])
+    | (?P<void>void\s+0\b)
+    | (?P<name>[A-Za-z_$][\w$]*)
+    | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    | (?P<punct>[\[\]{}:,])
+    | (?P<space>\s+)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+JSON_UNSAFE_ESCAPE_REGEX = re.compile(r'\\[^"\\/bfnrtu]')
+JS_ESCAPE_REGEX = re.compile(
+    r"\\(u\{[0-9a-fA-F]+\}|u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|\r\n|.)", re.DOTALL
+)
+JS_ESCAPES = {
+    "n": "\n",
+    "t": "\t",
+    "r": "\r",
+    "b": "\b",
+    "f": "\f",
+    "v": "\v",
+    "0": "\0",
+    "\n": "",
+    "\r\n": "",
+}
+NAME_VALUES = {"true": "true", "false": "false", "null": "null", "undefined": "null"}
+
+
+def decode_js_escape(match):
+    escape = match.group(1)
+    if escape.startswith("u{"):
+        return chr(int(escape[2:-1], 16))
+    if escape[0] in "ux" and len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return JS_ESCAPES.get(escape, escape)
+
+
+def js_string_to_json(token):
+    # Double quoted strings with JSON compatible escapes pass through as is
+    if token[0] == '"' and not JSON_UNSAFE_ESCAPE_REGEX.search(token):
+        return token
+    return json.dumps(JS_ESCAPE_REGEX.sub(decode_js_escape, token[1:-1]))
+
+
+def js_literal_to_json(text):
+    parts = []
+    pos = 0
+    for match in TOKEN_REGEX.finditer(text):
+        if match.start() != pos:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        token = match.group()
+        if kind == "string":
+            parts.append(js_string_to_json(token))
+        elif kind == "bool":
+            parts.append("true" if token == "!0" else "false")
+        elif kind == "void":
+            parts.append("null")
+        elif kind == "name":
+            # anything that isn't a literal has to be an object key
+            parts.append(NAME_VALUES.get(token) or f'"{token}"')
+        elif kind == "number":
+            parts.append(f"0{token}" if token.startswith(".") else token)
+        elif kind == "punct":
+            parts.append(token)
+
+    if pos != len(text):
+        raise ValueError(f"Unexpected character in JS literal at position {pos}")
+
+    return "".join(parts)
+
+
+def parse_js_literal(text):
+    return json.loads(js_literal_to_json(text), strict=False)
+
+
+def to_timestamp(date, tz):
+    return int(datetime.fromisoformat(date).replace(tzinfo=tz).timestamp())
+
+
+def parse_timeline(raw):
+    # raw is the whole timeline chunk, the event groups are its first array
+    info = parse_js_literal(raw[raw.index("[") : raw.index("];") + 1])
+
+    # unpack stuff and format dates
+    consolidated_event_list = []
+    for event_list in info:
+        for event in event_list:
+            try:
+                event["start"] = to_timestamp(
+                    event["start"],
+                    ASIA_TZ if event.get("timezoneDependent") else GMT_MINUS_5_TZ,
+                )
+                event["end"] = to_timestamp(event["end"], GMT_MINUS_5_TZ)
+                consolidated_event_list.append(event)
+            except Exception:
+                print(
+                    f"Ignoring event (maybe invalid date): start {event.get('start')} end {event.get('end')}"
+                )
+
+    return consolidated_event_list
+
+
+class EventIndex:
+    # Events ordered by start and by end, so current/upcoming lookups are a
+    # bisect plus the events returned
+    def __init__(self, events):
+        self.by_start = sorted(events, key=lambda event: event["start"])
+        self.starts = [event["start"] for event in self.by_start]
+        self.by_end = sorted(events, key=lambda event: event["end"])
+        self.ends = [event["end"] for event in self.by_end]
+
+    def current(self, now):
+        # sorted by end, like the current events page
+        return [
+            event
+            for event in self.by_end[bisect_left(self.ends, now) :]
+            if event["start"] <= now
+        ]
+
+    def upcoming(self, now):
+        # sorted by start
+        return self.by_start[bisect_right(self.starts, now) :]
+
+    def next_change(self, now):
+        # First second at which an event starts or ends, i.e. when the
+        # current/upcoming split next changes
+        changes = []
+        start_index = bisect_right(self.starts, now)
+        if start_index < len(self.starts):
+            changes.append(self.starts[start_index])
+        end_index = bisect_left(self.ends, now)
+        if end_index < len(self.ends):
+            changes.append(self.ends[end_index] + 1)
+        return min(changes) if changes else float("inf")
@@ -0,0 +1,176 @@
+import functools
+import heapq
+import json
+import logging
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import aiohttp
+
+import metrics
+
+DEFAULT_SLOW_TRACE_MS = 1000
+# Jobs walk every user, a full activity feed pass is routinely over a second
+DEFAULT_SLOW_JOB_TRACE_MS = 60000
+SLOW_TRACE_FILE = "slow_traces.jsonl"
+# Past this the file is rotated to slow_traces.jsonl.1, replacing the old one
+SLOW_TRACE_FILE_MAX_BYTES = 5 * 1024 * 1024
+MAX_RECENT_TRACES = 100
+# Spans kept per parent, a daily reward run would otherwise hold one per call
+MAX_CHILDREN = 200
+
+current_span = ContextVar("current_span", default=None)
+slow_trace_ms = DEFAULT_SLOW_TRACE_MS
+slow_job_trace_ms = DEFAULT_SLOW_JOB_TRACE_MS
+recent_traces = deque(maxlen=MAX_RECENT_TRACES)
+
+
+class Span:
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.children = []
+        self.dropped_children = 0
+        self.error = None
+        self.status = "ok"
+        self.started = time.time()
+        self.start_time = time.perf_counter()
+        self.duration = None
+        if parent is not None:
+            if len(parent.children) < MAX_CHILDREN:
+                parent.children.append(self)
+            else:
+                parent.dropped_children += 1
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self.start_time
+        if error is not None:
+            self.error = repr(error)
+            self.status = "error"
+        if self.parent is None:
+            record(self)
+
+    def to_dict(self):
+        data = {
+            "name": self.name,
+            "start": self.started,
+            "ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": self.status,
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.error:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.to_dict() for child in self.children]
+        if self.dropped_children:
+            data["dropped_children"] = self.dropped_children
+        return data
+
+
+def configure(settings):
+    global slow_trace_ms, slow_job_trace_ms
+    slow_trace_ms = settings.get("slow_trace_ms", DEFAULT_SLOW_TRACE_MS)
+    slow_job_trace_ms = settings.get("slow_job_trace_ms", DEFAULT_SLOW_JOB_TRACE_MS)
+
+
+def threshold_ms(trace):
+    return slow_job_trace_ms if trace.name.startswith("job.") else slow_trace_ms
+
+
+def record(trace):
+    if trace.duration * 1000 < threshold_ms(trace):
+        return
+
+    data = trace.to_dict()
+    recent_traces.append(data)
+    try:
+        if (
+            os.path.exists(SLOW_TRACE_FILE)
+            and os.path.getsize(SLOW_TRACE_FILE) >= SLOW_TRACE_FILE_MAX_BYTES
+        ):
+            os.replace(SLOW_TRACE_FILE, SLOW_TRACE_FILE + ".1")
+        with open(SLOW_TRACE_FILE, "a") as file:
+            file.write(json.dumps(data, default=str) + "\n")
+    except OSError:
+        logging.exception("Couldn't write slow trace")
+
+
+def slowest_traces(count=5):
+    return heapq.nlargest(count, recent_traces, key=lambda trace: trace["ms"])
+
+
+def begin(name, **attrs):
+    # Starts a span under the current one and makes it current, returns what
+    # end() needs to close it
+    span = Span(name, current_span.get(), **attrs)
+    return span, current_span.set(span)
+
+
+def end(span, token, error=None):
+    current_span.reset(token)
+    span.finish(error)
+
+
+@contextmanager
+def span(name, **attrs):
+    active_span, token = begin(name, **attrs)
+    error = None
+    try:
+        yield active_span
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        end(active_span, token, error)
+
+
+def child(name, **attrs):
+    # A leaf span that doesn't become current, for callbacks that can't wrap
+    # the work they time. Only recorded inside an existing trace.
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent, **attrs)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+async def on_request_start(session, context, params):
+    # Only the upstream and method, urls can carry tokens
+    context.span = child(
+        f"http.{metrics.upstream_for(params.url.host)}", method=params.method
+    )
+
+
+async def on_request_end(session, context, params):
+    if context.span:
+        context.span.attrs["status"] = params.response.status
+        context.span.finish()
+
+
+async def on_request_exception(session, context, params):
+    if context.span:
+        context.span.finish(params.exception)
+
+
+def trace_config():
+    config = aiohttp.TraceConfig()
+    config.on_request_start.append(on_request_start)
+    config.on_request_end.append(on_request_end)
+    config.on_request_exception.append(on_request_exception)
+    return config
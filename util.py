@@ -1,15 +1,21 @@
 import ast
 import asyncio
+import copy
+import inspect
 import json
+import logging
+import os
 import sys
+import tempfile
 import time
-from datetime import datetime, timezone
-from typing import List
+from datetime import timezone
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Union
 
 import genshin
-import requests
 import pytz
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from genshin import (
     Client,
     RedemptionInvalid,
@@ -22,9 +28,12 @@ from genshin.models.genshin.diary import Diary
 from nextcord import Interaction, Embed
 from nextcord.ui.view import View
 import nextcord
-import db
+import adb
+import client_pool
+import net
 import re
-import demjson
+import singleflight
+import timeline
 from diskcache import Cache
 
 GANYU_COLORS = {"light": 0xB5C5D7, "dark": 0x505EA9}
@@ -50,6 +59,11 @@ DAILY_HSR_REWARD_CRON_TRIGGER = CronTrigger(
     hour="18", timezone=pytz.UTC, jitter=3600  # anytime within that hour
 )
 
+# With claim_window set the claims are spread out by slot instead, jitter
+# would only shift every slot
+DAILY_REWARD_SLOT_TRIGGER = CronTrigger(hour="17", timezone=pytz.UTC)
+DAILY_HSR_REWARD_SLOT_TRIGGER = CronTrigger(hour="18", timezone=pytz.UTC)
+
 CODE_POLLER_CRON_TRIGGER = CronTrigger(
     hour="*/2", timezone=pytz.UTC, jitter=600  # 10 min jitter
 )
@@ -57,8 +71,19 @@ CODE_POLLER_CRON_TRIGGER = CronTrigger(
 ACTIVITY_FEED_CRON_TRIGGER = CronTrigger(minute="*/5", timezone=pytz.UTC)  # every 5 min
 ACTIVITY_FEED_CLEANUP_TRIGGER = CronTrigger(hour="0", timezone=pytz.UTC)  # once a day
 
+# Keeps the paimon.moe timeline fresh so /schedule never waits on it
+TIMELINE_REFRESH_TRIGGER = IntervalTrigger(minutes=30)
+
+# Commits pending writes when write-behind is enabled
+DB_FLUSH_TRIGGER = IntervalTrigger(seconds=5)
+
 cache = Cache("cache")
 
+TIMELINE_CACHE_KEY = "timeline_snapshot"
+TIMELINE_MAX_AGE = 3600  # 1 hr
+timeline_snapshot = None
+schedule_pages = None
+
 
 def get_scheduler_jobs(scheduler):
     jobs = scheduler.get_jobs()
@@ -71,58 +96,120 @@ def get_scheduler_jobs(scheduler):
     return detailed_jobs
 
 
-def get_schedule_info():
-    cache_key = "timeline"
-    if cache_key in cache:
-        return cache[cache_key]
+async def get_schedule_info():
+    # Always answers from the last good copy; a copy older than
+    # TIMELINE_MAX_AGE is refreshed in the background
+    global timeline_snapshot
+    if timeline_snapshot is None:
+        timeline_snapshot = cache.get(TIMELINE_CACHE_KEY)
+
+    if timeline_snapshot is None:
+        await refresh_schedule_info()
+        if timeline_snapshot is None:
+            return None
+    elif time.time() - timeline_snapshot["fetched"] > TIMELINE_MAX_AGE:
+        start_schedule_refresh()
+
+    return timeline_snapshot["events"]
+
+
+async def get_schedule_pages(avatar_url, detailed=False):
+    # Returns (page count, page_factory(index)) for a LazyMessageBook, or None.
+    # The current/upcoming split only changes when an event starts or ends, so
+    # it's worked out once per such interval; each page is rendered the first
+    # time anyone opens it and shared after that (the factory hands out copies)
+    global schedule_pages
+    events = await get_schedule_info()
+    if events is None:
+        return None
+
+    now = int(time.time())
+    if (
+        schedule_pages is None
+        or schedule_pages["events"] is not events
+        or now >= schedule_pages["valid_until"]
+    ):
+        if schedule_pages is not None and schedule_pages["events"] is events:
+            index = schedule_pages["index"]
+        else:
+            index = timeline.EventIndex(events)
+
+        schedule_pages = {
+            "events": events,
+            "index": index,
+            "valid_until": index.next_change(now),
+            "current": index.current(now),
+            "upcoming": index.upcoming(now),
+            "pages": {},
+        }
+
+    current = schedule_pages["current"]
+    upcoming = schedule_pages["upcoming"]
+    if detailed:
+        # event pages don't show the avatar
+        pages = schedule_pages["pages"].setdefault((None, True), {})
+        detailed_events = current + upcoming
+        page_count = len(detailed_events)
+
+        def render(index):
+            return create_event_embed(detailed_events[index])
+
+    else:
+        pages = schedule_pages["pages"].setdefault((avatar_url, False), {})
+        page_count = 2
+
+        def render(index):
+            return create_schedule_embed(
+                upcoming if index else current, avatar_url, bool(index)
+            )
+
+    def page_factory(index):
+        if index not in pages:
+            pages[index] = render(index)
+        return pages[index].copy()
+
+    return page_count, page_factory
+
 
-    timeline_js = get_paimon_moe_timeline_js()
+def start_schedule_refresh():
+    # Concurrent refreshes share one in-flight task
+    return singleflight.start(("paimon.moe", "timeline"), update_schedule_info)
+
+
+async def refresh_schedule_info():
+    return await asyncio.shield(start_schedule_refresh())
+
+
+async def update_schedule_info():
+    try:
+        events = await fetch_schedule_info()
+    except Exception:
+        logging.exception("Failed to refresh the paimon.moe timeline")
+        return None
+
+    # Stored without expiry so the last good copy survives upstream failures
+    # and restarts
+    global timeline_snapshot
+    if events:
+        timeline_snapshot = {"events": events, "fetched": int(time.time())}
+        cache.set(TIMELINE_CACHE_KEY, timeline_snapshot)
+    return events
+
+
+async def fetch_schedule_info():
+    timeline_js = await get_paimon_moe_timeline_js()
     if timeline_js:
-        res = requests.get(f"{PAIMON_MOE_URL_BASE}{timeline_js}")
-        raw = res.text
-        info = demjson.decode(
-            raw[raw.index("[") : raw.index("];") + 1].replace("!0", "1")
-        )
-        # unpack stuff and format dates
-        consolidated_event_list = []
-        for event_list in info:
-            for event in event_list:
-                try:
-                    if event.get("timezoneDependent"):
-                        # Asia time conversion
-                        event["start"] = int(
-                            datetime.strptime(event["start"], "%Y-%m-%d %H:%M:%S")
-                            .replace(tzinfo=pytz.timezone("Etc/GMT-8"))
-                            .timestamp()
-                        )
-                    else:
-                        # GMT+5 Conversion
-                        event["start"] = int(
-                            datetime.strptime(event["start"], "%Y-%m-%d %H:%M:%S")
-                            .replace(tzinfo=pytz.timezone("Etc/GMT+5"))
-                            .timestamp()
-                        )
-
-                    event["end"] = int(
-                        datetime.strptime(event["end"], "%Y-%m-%d %H:%M:%S")
-                        .replace(tzinfo=pytz.timezone("Etc/GMT+5"))
-                        .timestamp()
-                    )
-                    consolidated_event_list.append(event)
-                except:
-                    print(
-                        f"Ignoring event (maybe invalid date): start {event['start']} end {event['end']}"
-                    )
-
-        cache.set(cache_key, consolidated_event_list, expire=3600)  # 1 hr cache
-        return consolidated_event_list
+        raw = await net.get_text(f"{PAIMON_MOE_URL_BASE}{timeline_js}")
+        # parsing the bundle is CPU bound, keep it off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, timeline.parse_timeline, raw)
 
     return None
 
 
-def get_paimon_moe_timeline_js():
-    res = requests.get(f"{PAIMON_MOE_URL_BASE}/timeline/")
-    matches = re.findall(TIMELINE_REGEX, res.text)
+async def get_paimon_moe_timeline_js():
+    text = await net.get_text(f"{PAIMON_MOE_URL_BASE}/timeline/")
+    matches = re.findall(TIMELINE_REGEX, text)
     if len(matches) > 0:
         return matches[0]
     else:
@@ -136,15 +223,85 @@ def dict_factory(cursor, row):
     return d
 
 
+class SettingsStore:
+    # Keeps settings.json in memory, only re-reading it when the file on disk
+    # is replaced or modified (checked at most once per CHECK_INTERVAL)
+    CHECK_INTERVAL = 2
+
+    def __init__(self, path="settings.json"):
+        self.path = path
+        self.settings = None
+        self.mods = set()
+        self.file_id = None
+        self.last_check = 0
+        self.subscribers = []
+
+    def stat_file(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.settings is not None and now - self.last_check < self.CHECK_INTERVAL:
+            return
+
+        self.last_check = now
+        file_id = self.stat_file()
+        if file_id != self.file_id:
+            with open(self.path) as f:
+                settings = json.loads(f.read())
+            self.update(settings, file_id)
+
+    def update(self, settings, file_id):
+        changed = self.settings is not None and settings != self.settings
+        self.settings = settings
+        self.mods = set(settings.get("ganyu_mods", []))
+        self.file_id = file_id
+        if changed:
+            for callback in self.subscribers:
+                callback(copy.deepcopy(settings))
+
+    def get(self):
+        self.refresh()
+        # callers are free to modify their copy before set()
+        return copy.deepcopy(self.settings)
+
+    def set(self, settings):
+        # Write to a temp file and rename over the old one so readers never
+        # see a half written file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json.dumps(settings, indent=4, sort_keys=True))
+            os.replace(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+        self.update(copy.deepcopy(settings), self.stat_file())
+
+    def is_mod(self, discord_id):
+        self.refresh()
+        return discord_id in self.mods
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+
+settings_store = SettingsStore()
+
+
 def get_settings():
-    with open("settings.json") as f:
-        settings = json.loads(f.read())
-        return settings
+    return settings_store.get()
 
 
 def set_settings(settings):
-    with open("settings.json", "w+") as f:
-        f.write(json.dumps(settings, indent=4, sort_keys=True))
+    settings_store.set(settings)
+
+
+def is_mod(discord_id):
+    return settings_store.is_mod(discord_id)
 
 
 def create_link_profile_embed(
@@ -184,15 +341,18 @@ def create_reward_embed(name, amount, icon_url):
     return embed
 
 
-def create_status_embed(notes: Notes, avatar_url):
+def create_status_embed(notes: Notes, avatar_url, fetched_at=None):
     embed = nextcord.Embed(title="Status")
     embed.set_thumbnail(url=avatar_url)
+    if fetched_at:
+        embed.description = f"Updated <t:{fetched_at}:R>"
     embed.add_field(
         name="Commissions",
         value=f"{notes.completed_commissions}/{notes.max_commissions} Finished",
         inline=False,
     )
-    cur_time = time.time()
+    # remaining times are relative to when the notes were fetched
+    cur_time = fetched_at or time.time()
     recover_time = int(cur_time + notes.remaining_resin_recovery_time.total_seconds())
     embed.add_field(
         name="Resin",
@@ -230,9 +390,9 @@ def create_schedule_embed(event_list, avatar_url, future=False):
         title = "Current Events"
 
     if future:
-        event_list.sort(key=lambda x: x["start"])
+        event_list = sorted(event_list, key=lambda x: x["start"])
     else:
-        event_list.sort(key=lambda x: x["end"])
+        event_list = sorted(event_list, key=lambda x: x["end"])
 
     for event in event_list:
         name = event["name"]
@@ -286,11 +446,13 @@ def create_event_embed(event):
     return embed
 
 
-def create_report_overview_embed(data: Diary, avatar_url):
+def create_report_overview_embed(data: Diary, avatar_url, fetched_at=None):
     embed = nextcord.Embed(
         title="Income Overview",
         description="Does not include Welkins or top-up income.",
     )
+    if fetched_at:
+        embed.description += f"\nUpdated <t:{fetched_at}:R>"
     primo_percent = data.data.primogems_rate
     mora_percent = data.data.mora_rate
     if primo_percent > 0:
@@ -319,11 +481,13 @@ def create_report_overview_embed(data: Diary, avatar_url):
     return embed
 
 
-def create_report_breakdown_embed(data: Diary, avatar_url):
+def create_report_breakdown_embed(data: Diary, avatar_url, fetched_at=None):
     embed = nextcord.Embed(
         title="Income Breakdown",
         description="Does not include Welkins or top-up income.",
     )
+    if fetched_at:
+        embed.description += f"\nUpdated <t:{fetched_at}:R>"
     for category in data.data.categories:
         embed.add_field(
             name=category.name,
@@ -335,6 +499,40 @@ def create_report_breakdown_embed(data: Diary, avatar_url):
     return embed
 
 
+def create_traces_embed(traces, threshold_ms, job_threshold_ms):
+    embed = nextcord.Embed(
+        title="Slowest Recent Traces",
+        description=f"Traces slower than {threshold_ms} ms ({job_threshold_ms} ms for jobs)"
+        " since startup.",
+    )
+    if not traces:
+        embed.description += "\nNone yet!"
+
+    for trace in traces:
+        # total time spent per span name, directly under the root
+        breakdown = {}
+        for child in trace.get("children", []):
+            count, total = breakdown.get(child["name"], (0, 0))
+            breakdown[child["name"]] = (count + 1, total + (child["ms"] or 0))
+
+        lines = [f"<t:{int(trace['start'])}:R>"]
+        if trace.get("error"):
+            lines.append(f"Error: `{trace['error'][:100]}`")
+        for name, (count, total) in sorted(
+            breakdown.items(), key=lambda item: item[1][1], reverse=True
+        )[:5]:
+            lines.append(f"`{name}` x{count}: {total:.0f} ms")
+
+        embed.add_field(
+            name=f"{trace['name']} - {trace['ms']:.0f} ms",
+            value="\n".join(lines),
+            inline=False,
+        )
+
+    embed.colour = GANYU_COLORS["dark"]
+    return embed
+
+
 def create_code_announcement_embed(code: str):
     embed = nextcord.Embed(
         title=f"Redemption Code",
@@ -372,8 +570,10 @@ def loading_embed():
     return embed
 
 
-def create_activity_update_embed(discord_id, uid, db_data, new_data):
+def create_activity_update_embed(discord_id, uid, db_data, new_data, last_seen=None):
     embed = nextcord.Embed(title="🔵 Activity Update", description=f"<@{discord_id}>")
+    if last_seen:
+        embed.description += f"\nChanged since <t:{last_seen}:R>"
     fields = [
         ("level", "level", AEP_EMOJI, "Adventure Rank"),
         ("world_level", "worldLevel", "🌎", "World Level"),
@@ -415,6 +615,7 @@ class ProfileChoices(View):
         user_avatar,
         need_code_setup,
         base_interaction: Interaction,
+        user_data,
         probe=False,
         is_hsr=False,
     ):
@@ -423,11 +624,7 @@ class ProfileChoices(View):
         self.user_avatar = user_avatar
         self.user_name = user_name
         self.user_id = user_id
-        self.user_data = (
-            db.get_link_entry(self.user_id)
-            if not is_hsr
-            else db.get_hsr_link_entry(self.user_id)
-        )
+        self.user_data = user_data
         self.is_hsr = is_hsr
 
         toggle_check_in_button = nextcord.ui.Button(
@@ -466,7 +663,9 @@ class ProfileChoices(View):
             self.stop()
 
         if self.is_hsr:
-            db.set_hsr_daily_reward(self.user_id, not self.user_data["daily_reward"])
+            await adb.set_hsr_daily_reward(
+                self.user_id, not self.user_data["daily_reward"]
+            )
             self.user_data["daily_reward"] = not self.user_data["daily_reward"]
             user_settings = {
                 "HSR Auto Check-in": "No"
@@ -484,7 +683,7 @@ class ProfileChoices(View):
             or self.user_data["cookie_token"] is None
         )
 
-        db.set_daily_reward(self.user_id, not self.user_data["daily_reward"])
+        await adb.set_daily_reward(self.user_id, not self.user_data["daily_reward"])
         self.user_data["daily_reward"] = not self.user_data["daily_reward"]
 
         user_settings = {
@@ -509,7 +708,7 @@ class ProfileChoices(View):
             or self.user_data["cookie_token"] is None
         )
 
-        db.set_activity_tracking(self.user_id, not self.user_data["track"])
+        await adb.set_activity_tracking(self.user_id, not self.user_data["track"])
         self.user_data["track"] = not self.user_data["track"]
 
         user_settings = {
@@ -564,7 +763,7 @@ class MessageBook(View):
 
     async def next_page(self):
         self.current_page += 1
-        if self.current_page > len(self.pages) - 1:
+        if self.current_page > self.page_count - 1:
             self.current_page = 0
 
         await self.update_page()
@@ -572,15 +771,60 @@ class MessageBook(View):
     async def prev_page(self):
         self.current_page -= 1
         if self.current_page < 0:
-            self.current_page = len(self.pages) - 1
+            self.current_page = self.page_count - 1
 
         await self.update_page()
 
     async def update_page(self):
         await self.base_interaction.edit_original_message(
-            embed=self.pages[self.current_page]
+            embed=await self.get_page(self.current_page)
         )
 
+    async def get_page(self, index):
+        return self.pages[index]
+
+
+class LazyMessageBook(MessageBook):
+    # Renders pages through page_factory(index) (sync or async) only when
+    # they're navigated to, keeping the last few around
+    CACHE_WINDOW = 3
+
+    def __init__(
+        self,
+        user_id: int,
+        user_avatar_url: str,
+        page_count: int,
+        page_factory: Callable[[int], Union[Embed, Awaitable[Embed]]],
+        base_interaction: Interaction,
+    ):
+        View.__init__(self, timeout=120)
+        self.page_count = page_count
+        self.page_factory = page_factory
+        self.rendered_pages = OrderedDict()
+        self.base_interaction = base_interaction
+        self.user_avatar_url = user_avatar_url
+        self.user_id = user_id
+        self.current_page = 0
+
+    async def get_page(self, index):
+        if index in self.rendered_pages:
+            self.rendered_pages.move_to_end(index)
+            return self.rendered_pages[index]
+
+        page = self.page_factory(index)
+        if inspect.isawaitable(page):
+            page = await page
+
+        page.set_footer(
+            text=f"Page {index + 1} of {self.page_count}",
+            icon_url=self.user_avatar_url,
+        )
+        self.rendered_pages[index] = page
+        while len(self.rendered_pages) > self.CACHE_WINDOW:
+            self.rendered_pages.popitem(last=False)
+
+        return page
+
 
 class CodeAnnouncement(View):
     def __init__(self, code: str):
@@ -600,7 +844,7 @@ class CodeAnnouncement(View):
 
     async def redeem(self, interaction: nextcord.Interaction):
         discord_id = interaction.user.id
-        user_data = db.get_link_entry(discord_id)
+        user_data = await adb.get_link_entry(discord_id)
         if not user_data:
             await interaction.response.send_message(
                 embed=create_message_embed(
@@ -625,16 +869,12 @@ class CodeAnnouncement(View):
             )
             return
 
-        user_client = Client(
-            {
-                "ltuid": user_data["ltuid"],
-                "ltoken": user_data["ltoken"],
-                "account_id": user_data["account_id"],
-                "cookie_token": user_data["cookie_token"],
-            }
+        user_client = get_client(
+            user_data["ltuid"],
+            user_data["ltoken"],
+            account_id=user_data["account_id"],
+            cookie_token=user_data["cookie_token"],
         )
-
-        user_client.default_game = genshin.Game.GENSHIN
         # Using API takes time, keep interaction alive by sending a "loading" response
         await interaction.response.send_message(embed=loading_embed(), ephemeral=True)
         try:
@@ -667,37 +907,66 @@ class CodeAnnouncement(View):
             await interaction.edit_original_message(embed=embed)
 
 
-def get_client(ltuid: str, ltoken: str, is_genshin=True) -> Client:
-    if ltoken.startswith("v2"):
-        client = Client({"ltuid_v2": ltuid, "ltoken_v2": ltoken})
-    else:
-        client = Client({"ltuid": ltuid, "ltoken": ltoken})
+def get_client(
+    ltuid: str,
+    ltoken: str,
+    is_genshin=True,
+    account_id: str = None,
+    cookie_token: str = None,
+) -> Client:
+    def create_client():
+        if ltoken.startswith("v2"):
+            cookies = {"ltuid_v2": ltuid, "ltoken_v2": ltoken}
+        else:
+            cookies = {"ltuid": ltuid, "ltoken": ltoken}
+
+        if account_id and cookie_token:
+            cookies["account_id"] = account_id
+            cookies["cookie_token"] = cookie_token
+
+        client = Client(cookies)
+        if is_genshin:
+            client.default_game = genshin.Game.GENSHIN
 
-    if is_genshin:
-        client.default_game = genshin.Game.GENSHIN
+        return client
 
-    return client
+    key = ("genshin" if is_genshin else None, ltuid, ltoken, account_id, cookie_token)
+    return client_pool.pool.get(key, create_client)
 
 
 def get_hsr_client(
     ltuid: str, ltoken: str, account_mid: str, cookie_token: str
 ) -> Client:
-    params = {}
-    if ltoken.startswith("v2"):
-        params["ltuid_v2"] = ltuid
-        params["ltoken_v2"] = ltoken
-    else:
-        params["ltuid"] = ltuid
-        params["ltoken"] = ltoken
-
-    if cookie_token.startswith("v2"):
-        params["account_mid_v2"] = account_mid
-        params["cookie_token_v2"] = cookie_token
-    else:
-        params["account_mid"] = account_mid
-        params["cookie_token"] = cookie_token
-
-    client = Client(params)
-    client.default_game = genshin.Game.STARRAIL
-
-    return client
+    def create_client():
+        params = {}
+        if ltoken.startswith("v2"):
+            params["ltuid_v2"] = ltuid
+            params["ltoken_v2"] = ltoken
+        else:
+            params["ltuid"] = ltuid
+            params["ltoken"] = ltoken
+
+        if cookie_token.startswith("v2"):
+            params["account_mid_v2"] = account_mid
+            params["cookie_token_v2"] = cookie_token
+        else:
+            params["account_mid"] = account_mid
+            params["cookie_token"] = cookie_token
+
+        client = Client(params)
+        client.default_game = genshin.Game.STARRAIL
+
+        return client
+
+    key = ("hsr", ltuid, ltoken, account_mid, cookie_token)
+    return client_pool.pool.get(key, create_client)
+
+
+def discard_clients(user_data):
+    # Drops the pooled clients built from user_data's cookies, once a relink
+    # replaced them they'd only sit in the pool until they idle out
+    if not user_data:
+        return
+    cookies = (user_data["ltuid"], user_data["ltoken"])
+    for key in [key for key in client_pool.pool.clients if key[1:3] == cookies]:
+        client_pool.pool.discard(key)
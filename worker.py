@@ -0,0 +1,79 @@
+# Runs the daily reward jobs outside the gateway bot, split into shards by
+# discord_id hash so several processes can claim at once.
+#
+#   python worker.py daily_rewards --shards 4              every shard, one process each
+#   python worker.py daily_rewards --shard 1 --shards 4    only shard 1
+#
+# Either way today's unfinished run is resumed if there is one.
+#
+# The bot does the same when claim_shards is set above 1 in settings.json, and
+# posts one summary for all shards to the log channel.
+import argparse
+import asyncio
+import logging
+
+import adb
+import db
+import net
+import rewards
+import util
+
+logging.basicConfig()
+logging.getLogger().setLevel(logging.INFO)
+
+
+async def run_shard(job, shard, shards, run_id):
+    settings = util.get_settings()
+    # every checkpoint committed right away, shards share the database
+    await adb.init()
+
+    async def report(result, finished=False):
+        await adb.save_shard_report(
+            run_id,
+            shard,
+            job,
+            result["total"],
+            result["claimed"],
+            result["failed"],
+            finished,
+            result["skipped"],
+            result["quarantined"],
+        )
+
+    # clears finished from an earlier attempt at this run
+    await report(rewards.empty_result())
+    batches = await rewards.JOBS[job](shard, shards)
+    result = await rewards.collect(settings, run_id, batches, report, shards)
+    await report(result, finished=True)
+    logging.info(
+        f"{job} shard {shard + 1}/{shards}: claimed {result['claimed']}/{result['total']}"
+    )
+    await net.close()
+    await adb.run(db.close)
+
+
+async def run_all(job, shards):
+    settings = util.get_settings()
+    await adb.init(write_behind=settings.get("db_write_behind", False))
+    result = await rewards.run(job, settings, shards)
+    logging.info(
+        f"{job} run {result['run_id']}: claimed {result['claimed']}/{result['total']},"
+        f" {len(result['failed']['users']) + len(result['failed']['alts'])} failed"
+    )
+    await adb.run(db.close)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("job", choices=list(rewards.JOBS))
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--shard", type=int, help="run only this shard (0 based)")
+    parser.add_argument("--run-id", default=None)
+    args = parser.parse_args()
+
+    if args.shard is None:
+        asyncio.run(run_all(args.job, args.shards))
+    elif not args.run_id:
+        parser.error("--shard needs the --run-id of the run it belongs to")
+    else:
+        asyncio.run(run_shard(args.job, args.shard, args.shards, args.run_id))